@@ -0,0 +1,140 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+
+class AnnotationCache(object):
+  """Persists Natural Language API annotations between runs in SQLite.
+
+  Annotations are keyed by a hash of the annotateText request body, i.e. of the
+  text, its language and the requested features, so a review is only annotated
+  again when one of them changes. The least recently used annotations are
+  evicted once the cache grows beyond its maximum size.
+  """
+
+  def __init__(self, path, max_bytes):
+    self.max_bytes = max_bytes
+    self.lock = threading.Lock()
+    self.connection = sqlite3.connect(path, check_same_thread=False)
+    self.hits = 0
+    self.misses = 0
+
+    with self.lock, self.connection:
+      self.connection.execute("""
+          CREATE TABLE IF NOT EXISTS annotations (
+            key TEXT NOT NULL PRIMARY KEY,
+            annotation TEXT NOT NULL,
+            used REAL NOT NULL
+          )""")
+      self.connection.execute(
+          "CREATE INDEX IF NOT EXISTS annotations_used ON annotations (used)"
+      )
+      self.size = self.connection.execute(
+          "SELECT COALESCE(SUM(LENGTH(annotation)), 0) FROM annotations"
+      ).fetchone()[0]
+
+  @staticmethod
+  def key(body):
+    """Returns the cache key of an annotateText request body.
+
+    Args:
+      body: the annotateText request body.
+
+    Returns:
+      The SHA-256 hex digest of the body.
+    """
+    return hashlib.sha256(
+        json.dumps(body, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+  def get(self, body):
+    """Returns the cached annotation for an annotateText request body.
+
+    Args:
+      body: the annotateText request body.
+
+    Returns:
+      The annotation, or None if it is not cached.
+    """
+    key = self.key(body)
+    with self.lock, self.connection:
+      row = self.connection.execute(
+          "SELECT annotation FROM annotations WHERE key = ?", (key,)
+      ).fetchone()
+      if not row:
+        self.misses = self.misses + 1
+        return None
+
+      self.hits = self.hits + 1
+      self.connection.execute(
+          "UPDATE annotations SET used = ? WHERE key = ?", (time.time(), key)
+      )
+
+    return json.loads(row[0])
+
+  def put(self, body, annotation):
+    """Caches the annotation returned for an annotateText request body.
+
+    Args:
+      body: the annotateText request body.
+      annotation: the annotateText response.
+    """
+    key = self.key(body)
+    value = json.dumps(annotation)
+    with self.lock, self.connection:
+      row = self.connection.execute(
+          "SELECT LENGTH(annotation) FROM annotations WHERE key = ?", (key,)
+      ).fetchone()
+      self.connection.execute(
+          "INSERT OR REPLACE INTO annotations (key, annotation, used)"
+          " VALUES (?, ?, ?)",
+          (key, value, time.time()),
+      )
+      self.size = self.size + len(value) - (row[0] if row else 0)
+      if self.size > self.max_bytes:
+        self.evict()
+
+  def evict(self):
+    """Deletes the least recently used annotations down to 90% of the size."""
+    target = self.max_bytes * 0.9
+    evicted = []
+    for key, size in self.connection.execute(
+        "SELECT key, LENGTH(annotation) FROM annotations ORDER BY used"
+    ):
+      if self.size <= target:
+        break
+      evicted.append((key,))
+      self.size = self.size - size
+
+    self.connection.executemany(
+        "DELETE FROM annotations WHERE key = ?", evicted
+    )
+    logging.debug(f"Evicted {len(evicted)} annotations from the cache.")
+
+  def close(self):
+    """Logs the hit rate of the cache and closes it."""
+    lookups = self.hits + self.misses
+    if lookups:
+      logging.info(
+          f"Annotation cache: {self.hits} hits out of {lookups} lookups"
+          f" ({self.hits * 100 // lookups}%), saving {self.hits} Natural"
+          " Language API calls."
+      )
+    self.connection.close()
@@ -12,23 +12,48 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from colorama import Fore, Style
+import concurrent.futures
+import contextlib
 import json
 import logging
 import os
+import queue
 import re
 import sys
+import threading
+import time
 
 from urllib import parse
 from babel import Locale
 from babel.core import UnknownLocaleError
+import httplib2
 from google.auth.transport.requests import Request
+from google_auth_httplib2 import AuthorizedHttp
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from oauthlib.oauth2.rfc6749.errors import InvalidGrantError
 from googleapiclient import discovery
 from googleapiclient.errors import HttpError
+from googleapiclient.http import HttpRequest
+try:
+  from google.cloud import bigquery_storage
+except ImportError:
+  bigquery_storage = None
+from annotation_cache import AnnotationCache
+from rate_limit import TokenBucket
+from sinks import BigQueryLoadJobSink
+from sinks import BigQuerySink
+from sinks import DuckDBSink
+from sinks import ParquetSink
+from state import StateStore
+from topic_clustering import CLUSTERS_PATIENCE
+from topic_clustering import EMBEDDING_STORE_ROWS
+from topic_clustering import MAX_CLUSTERS
+from topic_clustering import MIN_CLUSTERS
+from topic_clustering import SCORE_THRESHOLD
+from topic_clustering import SILHOUETTE
 from topic_clustering import TopicClustering
 
 INVALID_REDIRECT_URI = "http://localhost:5678"
@@ -40,6 +65,8 @@ CLIENT_SECRETS_FILE = "client_secrets.json"
 TOKEN_FILE = "token.json"
 SCHEMAS_FILE = "schemas.json"
 SENTIMENTS_LASTRUN_FILE = "sentiments_lastrun"
+STATE_FILE = "alligator_state.db"
+ANNOTATION_CACHE_FILE = "alligator_annotations.db"
 SCOPES = [
     "https://www.googleapis.com/auth/business.manage",
     "https://www.googleapis.com/auth/bigquery",
@@ -50,10 +77,47 @@ MAX_RETRIES = 10
 MIN_TOKENS = 20
 INSIGHTS_DAYS_BACK = 540
 CALLS_DAYS_BACK = 7
+SETTLE_DAYS_BACK = 3
 DIRECTIONS_NUM_DAYS = "SEVEN"
 LOCATIONS_PER_PAGE = 100
+LOCATIONS_PER_INSIGHTS_REQUEST = 10
+MAX_REQUESTS_PER_BATCH = 100
 BQ_JOBS_QUERY_MAXRESULTS_PER_PAGE = 1000
-BQ_TABLEDATA_INSERTALL_BATCHSIZE = 50
+NLP_REQUESTS_PER_MINUTE = 600
+ANNOTATION_CACHE_MB = 256
+TRANSLATED_TEXT = "translated"
+ORIGINAL_TEXT = "original"
+BOTH_TEXTS = "both"
+TRANSLATED_MARKER = "(Translated by Google)"
+ORIGINAL_MARKER = "(Original)"
+DEFAULT_NLP_FEATURES = "default"
+# The annotateText features requested by each --nlp_features profile. Syntax
+# is added whenever topic clustering is enabled, since it needs the nouns.
+NLP_FEATURE_PROFILES = {
+    "all": [
+        "extractSyntax",
+        "extractEntities",
+        "extractDocumentSentiment",
+        "extractEntitySentiment",
+        "classifyText",
+    ],
+    DEFAULT_NLP_FEATURES: [
+        "extractEntities",
+        "extractDocumentSentiment",
+        "extractEntitySentiment",
+        "classifyText",
+    ],
+    "sentiment": ["extractDocumentSentiment"],
+    "entities": ["extractEntities", "extractEntitySentiment"],
+}
+WRITE_BUFFER_MAX_BYTES = 32 * 1024 * 1024
+WRITE_BUFFER_MAX_SECONDS = 60
+WRITE_BUFFER_CHECK_SECONDS = 1
+STREAMING_SINK = "streaming"
+LOAD_JOB_SINK = "load_job"
+BIGQUERY_SINK = "bigquery"
+PARQUET_SINK = "parquet"
+DUCKDB_SINK = "duckdb"
 
 LOCATIONS_READ_MASK = (
     "regularHours,latlng,labels,metadata,relationshipData,"
@@ -66,6 +130,88 @@ LOCATIONS_READ_MASK = (
 logging.getLogger("googleapiclient.discovery_cache").setLevel(logging.CRITICAL)
 
 
+def query_rows(rows):
+  """Converts the rows of the reviews query from the jobs.query format.
+
+  Args:
+    rows: the rows of a jobs.query or jobs.getQueryResults response.
+
+  Returns:
+    A list of dicts with the comment, name, reviewId, partitionTime and
+    commentHash of each review.
+  """
+  return [
+      {
+          "comment": row.get("f")[0].get("v"),
+          "name": row.get("f")[1].get("v"),
+          "reviewId": row.get("f")[2].get("v"),
+          "partitionTime": row.get("f")[3].get("v"),
+          "commentHash": row.get("f")[4].get("v"),
+      }
+      for row in rows
+  ]
+
+
+def review_text(comment, variant):
+  """Returns one language variant of a review translated by Google.
+
+  Translated reviews hold both the translation and the original text, each one
+  following its marker, e.g. "(Translated by Google) Great food (Original)
+  Comida genial". Reviews without a translation are returned as they are.
+
+  Args:
+    comment: the comment of the review.
+    variant: TRANSLATED_TEXT, ORIGINAL_TEXT or BOTH_TEXTS.
+
+  Returns:
+    The requested variant of the comment.
+  """
+  translated = comment.find(TRANSLATED_MARKER) if comment else -1
+  if variant == BOTH_TEXTS or translated == -1:
+    return comment
+
+  original = comment.find(ORIGINAL_MARKER)
+  translation_start = translated + len(TRANSLATED_MARKER)
+  original_start = original + len(ORIGINAL_MARKER)
+  if original == -1:
+    texts = {
+        ORIGINAL_TEXT: comment[:translated],
+        TRANSLATED_TEXT: comment[translation_start:],
+    }
+  elif original > translated:
+    texts = {
+        TRANSLATED_TEXT: comment[translation_start:original],
+        ORIGINAL_TEXT: comment[original_start:],
+    }
+  else:
+    texts = {
+        ORIGINAL_TEXT: comment[original_start:translated],
+        TRANSLATED_TEXT: comment[translation_start:],
+    }
+
+  return texts[variant].strip() or comment
+
+
+def review_time(timestamp):
+  """Normalizes an RFC 3339 review timestamp so that it sorts as a string.
+
+  The API returns timestamps with a varying number of fractional digits (e.g.
+  "2021-01-01T10:00:00Z" and "2021-01-01T10:00:00.123Z"), so they are padded to
+  nanosecond precision.
+
+  Args:
+    timestamp: the updateTime or createTime of a review.
+
+  Returns:
+    The normalized timestamp, or an empty string if there is none.
+  """
+  if not timestamp:
+    return ""
+
+  seconds, _, fraction = timestamp.rstrip("Z").partition(".")
+  return f"{seconds}.{fraction.ljust(9, '0')}Z"
+
+
 class API(object):
 
   def __init__(self, project_id, language, flags):
@@ -113,32 +259,104 @@ class API(object):
         token.write(creds.to_json())
         logging.info(f"Succesfully created an authorization token.")
 
+    self.credentials = creds
+    # httplib2 is not thread-safe, so when requests are sent from several
+    # threads every request gets its own authorized http object instead of
+    # sharing one.
+    service_args = {"credentials": creds}
+    if (
+        flags.get("workers", 1) > 1
+        or flags.get("writers")
+        or flags.get("bq_inflight", 1) > 1
+        or flags.get("bq_buffer_rows")
+        or flags.get("nlp_workers", 1) > 1
+    ):
+      service_args = {
+          "http": AuthorizedHttp(creds, http=httplib2.Http()),
+          "requestBuilder": self.build_request,
+      }
+
     self.gmb_services = {}
     for service_name in FEDERATED_SERVICES:
       self.gmb_services[service_name] = discovery.build(
-          service_name, "v1", credentials=creds
+          service_name, "v1", **service_args
       )
 
     with open(GMB_DISCOVERY_FILE) as gmb_discovery_file:
       self.gmb_service = discovery.build_from_document(
           gmb_discovery_file.read(),
           base="https://www.googleapis.com/",
-          credentials=creds,
+          **service_args,
       )
 
     self.project_id = project_id
-    self.dataset_exists = False
-    self.existing_tables = {}
     self.language = language
 
     with open(SCHEMAS_FILE) as schemas_file:
       self.schemas = json.load(schemas_file)
 
-    self.bq_service = discovery.build("bigquery", "v2", credentials=creds)
-    self.nlp_service = discovery.build("language", "v1", credentials=creds)
+    self.state = StateStore(
+        os.path.join(os.path.dirname(__file__), STATE_FILE)
+    )
+
+    self.bq_service = discovery.build("bigquery", "v2", **service_args)
+    self.nlp_service = discovery.build("language", "v1", **service_args)
+    self.nlp_limiter = TokenBucket(
+        flags.get("nlp_rpm", NLP_REQUESTS_PER_MINUTE) / 60
+    )
+    self.annotation_cache = None
+    annotation_cache_mb = flags.get("nlp_cache_mb", ANNOTATION_CACHE_MB)
+    if annotation_cache_mb:
+      self.annotation_cache = AnnotationCache(
+          os.path.join(os.path.dirname(__file__), ANNOTATION_CACHE_FILE),
+          annotation_cache_mb * 1024 * 1024,
+      )
+
+    sink_args = [
+        self.bq_service,
+        project_id,
+        DATASET_ID,
+        self.schemas,
+        MAX_RETRIES,
+        flags.get("bq_inflight", 1),
+    ]
+    if flags.get("bq_sink") == LOAD_JOB_SINK:
+      self.bigquery = BigQueryLoadJobSink(*sink_args)
+    else:
+      self.bigquery = BigQuerySink(*sink_args)
+
+    sink = flags.get("sink", BIGQUERY_SINK)
+    if sink == PARQUET_SINK:
+      self.setup_writes(
+          ParquetSink(flags.get("sink_path", "alligator"), self.schemas)
+      )
+    elif sink == DUCKDB_SINK:
+      self.setup_writes(
+          DuckDBSink(flags.get("sink_path", "alligator.duckdb"), self.schemas)
+      )
+    else:
+      self.setup_writes(self.bigquery)
 
+    self.topic_clustering = None
     if flags["topic_clustering"]:
-      self.topic_clustering = TopicClustering()
+      self.topic_clustering = TopicClustering(
+          flags.get("model_cache_dir"),
+          list(
+              range(
+                  flags.get("min_clusters", MIN_CLUSTERS),
+                  flags.get("max_clusters", MAX_CLUSTERS) + 1,
+              )
+          ),
+          flags.get("clusters_patience", CLUSTERS_PATIENCE),
+          flags.get("cluster_score", SILHOUETTE),
+          flags.get("cluster_score_threshold", SCORE_THRESHOLD),
+          flags.get("embedding_store_rows", EMBEDDING_STORE_ROWS),
+      )
+
+  def build_request(self, http, *args, **kwargs):
+    del http
+    new_http = AuthorizedHttp(self.credentials, http=httplib2.Http())
+    return HttpRequest(new_http, *args, **kwargs)
 
   def accounts(self):
     data = []
@@ -203,69 +421,169 @@ class API(object):
 
   def reviews(self, location_id):
     page_token = None
+    watermark = None
+    if self.flags.get("incremental_reviews") and not self.flags.get(
+        "full_resync"
+    ):
+      watermark = self.state.get_watermark("reviews", location_id)
+    newest_update_time = watermark
+    complete = False
+
+    with self.tracking_writes() as writes:
+      while True:
+        try:
+          response_json = (
+              self.gmb_service.accounts()
+              .locations()
+              .reviews()
+              .list(
+                  parent=location_id,
+                  pageToken=page_token,
+                  orderBy="updateTime desc",
+              )
+              .execute(num_retries=MAX_RETRIES)
+          )
+        except HttpError as err:
+          # Known bug on the GMB side, causing requests to return a 500
+          # for locations with many thousands or reviews.
+          # Workaround for now: stop listing reviews and log the error.
+          logging.error(
+              f"Failed to list reviews for location_id={location_id} "
+              f"and pageToken={page_token} with error: {str(err)}"
+          )
+          break
 
-    while True:
-      try:
-        response_json = (
-            self.gmb_service.accounts()
-            .locations()
-            .reviews()
-            .list(parent=location_id, pageToken=page_token)
-            .execute(num_retries=MAX_RETRIES)
-        )
-      except HttpError as err:
-        # Known bug on the GMB side, causing requests to return a 500
-        # for locations with many thousands or reviews.
-        # Workaround for now: stop listing reviews and log the error.
-        logging.error(
-            f"Failed to list reviews for location_id={location_id} "
-            f"and pageToken={page_token} with error: {str(err)}"
-        )
-        break
+        page_reviews = response_json.get("reviews") or []
+        data = page_reviews
+        if watermark:
+          # Reviews are listed newest first, so once a page holds a review
+          # which was already loaded there is nothing new left to list.
+          data = [
+              review
+              for review in page_reviews
+              if review_time(review.get("updateTime")) > watermark
+          ]
+        logging.debug(json.dumps(data, indent=2))
+        self.to_bigquery(table_name="reviews", data=data)
+
+        for review in data:
+          update_time = review_time(review.get("updateTime"))
+          if not newest_update_time or update_time > newest_update_time:
+            newest_update_time = update_time
 
-      data = response_json.get("reviews") or []
-      logging.debug(json.dumps(data, indent=2))
-      self.to_bigquery(table_name="reviews", data=data)
+        page_token = response_json.get("nextPageToken")
+        if not page_token or len(data) < len(page_reviews):
+          complete = True
+          break
 
-      page_token = response_json.get("nextPageToken")
-      if not page_token:
-        break
+    # The watermark only advances once all the new reviews have been loaded,
+    # otherwise the reviews of a failed page would never be listed again.
+    if complete and newest_update_time and newest_update_time != watermark:
+      self.when_written(
+          writes,
+          self.state.set_watermark,
+          "reviews",
+          location_id,
+          newest_update_time,
+      )
 
   def sentiments(self):
+    if self.sink is not self.bigquery:
+      logging.warning(
+          "Skipping the sentiment analysis, which reads the reviews from"
+          " BigQuery and is not available with local sinks."
+      )
+      return
+
     page_token = None
-    lastrun, file_exists = self.get_sentiments_lastrun()
+    watermark = self.get_sentiments_watermark()
 
-    self.ensure_dataset_exists()
-    self.ensure_table_exists(table_name="reviews")
+    # Reviews still waiting in the write queue have to be in BigQuery first.
+    self.flush()
+    self.bigquery.ensure_dataset_exists()
+    self.bigquery.ensure_table_exists(table_name="reviews")
+    self.bigquery.ensure_table_exists(table_name="sentiments")
 
-    if file_exists:
+    if watermark:
+      lastrun = datetime.fromtimestamp(watermark / 1000000, timezone.utc)
       logging.info(
-          f"Sentiment analysis last run: [{lastrun}]. Performing sentiment"
-          " analysis on newer reviews..."
+          "Sentiment analysis complete up to the partition of:"
+          f" [{lastrun.date()}]. Performing sentiment analysis on the reviews"
+          " of the newer partitions..."
       )
     else:
+      watermark = 0
       logging.info(
           "No previous run for sentiment analysis found. Performing sentiment"
           " analysis on all available reviews..."
       )
 
+    # Only the latest version of every review is selected, and only if its
+    # comment has not been annotated yet: reviews are written again into the
+    # current partition on every run, mostly unchanged. Reviews still in the
+    # streaming buffer belong to the current partition.
+    #
+    # The annotations of a review can be in any partition of the sentiments
+    # table, however old, so the sentiments table cannot be pruned by
+    # partition. It is compared on a fingerprint of the name and comment of
+    # the reviews instead, stored with every annotation, so that the query
+    # only scans 8 bytes per annotation rather than all the comments.
     query = {
         "query": f"""
           SELECT
-            comment,
-            name,
-            reviewId
-          FROM
-            [{self.project_id}:{DATASET_ID}.reviews]
+            reviews.comment,
+            reviews.name,
+            reviews.reviewId,
+            reviews.partitionTime,
+            reviews.commentHash
+          FROM (
+            SELECT
+              comment,
+              name,
+              reviewId,
+              FARM_FINGERPRINT(CONCAT(name, "\\n", comment)) AS commentHash,
+              UNIX_MICROS(
+                IFNULL(
+                  _PARTITIONTIME,
+                  TIMESTAMP_TRUNC(CURRENT_TIMESTAMP(), DAY)))
+                AS partitionTime
+            FROM
+              `{self.project_id}.{DATASET_ID}.reviews`
+            WHERE
+                LENGTH(comment) > 100
+              AND (
+                _PARTITIONTIME >= TIMESTAMP_MICROS(@watermark_time)
+                OR
+                  _PARTITIONTIME IS NULL)
+            QUALIFY
+              ROW_NUMBER() OVER (PARTITION BY name ORDER BY updateTime DESC)
+                = 1) AS reviews
+          LEFT JOIN
+            `{self.project_id}.{DATASET_ID}.sentiments` AS sentiments
+          ON
+            sentiments.commentHash = reviews.commentHash
           WHERE
-              LENGTH(comment) > 100
-            AND (
-              DATE(_PARTITIONTIME) > "{lastrun}"
-              OR
-                _PARTITIONTIME IS NULL)""",
+            sentiments.commentHash IS NULL
+          ORDER BY
+            reviews.partitionTime,
+            reviews.name""",
+        "useLegacySql": False,
+        "parameterMode": "NAMED",
+        "queryParameters": [
+            {
+                "name": "watermark_time",
+                "parameterType": {"type": "INT64"},
+                "parameterValue": {"value": str(watermark)},
+            },
+        ],
         "maxResults": BQ_JOBS_QUERY_MAXRESULTS_PER_PAGE,
     }
 
+    if self.flags.get("read_streams"):
+      self.read_reviews_in_streams(query)
+      self.flush()
+      return
+
     page_ctr = 1
     message = (
         "Fetching reviews for sentiment analysis..."
@@ -279,8 +597,9 @@ class API(object):
         .execute(num_retries=MAX_RETRIES)
     )
 
+    writes = []
     rows = response_json.get("rows") or []
-    self.process_sentiments(rows)
+    self.process_sentiments_page(query_rows(rows), writes)
 
     page_token = response_json.get("pageToken")
     if page_token:
@@ -302,42 +621,262 @@ class API(object):
         )
 
         rows_job = response_json_job.get("rows") or []
-        self.process_sentiments(rows_job)
+        self.process_sentiments_page(query_rows(rows_job), writes)
 
         page_token = response_json_job.get("pageToken")
         if not page_token:
           break
 
-    self.set_sentiments_lastrun()
+    self.flush()
+
+  def process_sentiments_page(self, rows, writes):
+    """Analyzes a page of reviews, in the order of the sentiments watermark.
+
+    The watermark advances to the partition of the last review of the page
+    once the page and all the previous ones have been written, so an
+    interrupted analysis resumes from the last partition committed to BigQuery.
+    Reviews of that partition which were already analyzed are skipped by the
+    query.
+
+    Args:
+      rows: the reviews of the page, ordered by partition time and name.
+      writes: the writes of the previous pages, extended with this page's.
+    """
+    if not rows:
+      return
+
+    with self.tracking_writes() as page_writes:
+      self.process_sentiments(rows)
+    writes.extend(page_writes)
+
+    self.when_written(
+        list(writes),
+        self.set_sentiments_watermark,
+        int(rows[-1].get("partitionTime")),
+    )
+
+  def read_reviews_in_streams(self, query):
+    """Reads the reviews selected by a query through parallel read streams.
+
+    The query results are read from the query's destination table with the
+    BigQuery Storage Read API, as Arrow record batches. Every stream is read by
+    its own thread, and the reviews are processed as soon as a full page of
+    them has arrived from any of the streams.
+
+    Args:
+      query: the jobs.query request body selecting the reviews.
+    """
+    if not bigquery_storage:
+      raise ImportError(
+          "--read_streams requires: pip install google-cloud-bigquery-storage"
+          " pyarrow"
+      )
+
+    response_json = (
+        self.bq_service.jobs()
+        .query(projectId=self.project_id, body=dict(query, maxResults=0))
+        .execute(num_retries=MAX_RETRIES)
+    )
+    job_reference = response_json.get("jobReference")
+
+    while not response_json.get("jobComplete"):
+      response_json = (
+          self.bq_service.jobs()
+          .getQueryResults(
+              projectId=self.project_id,
+              jobId=job_reference.get("jobId"),
+              location=job_reference.get("location"),
+              maxResults=0,
+          )
+          .execute(num_retries=MAX_RETRIES)
+      )
+
+    job = (
+        self.bq_service.jobs()
+        .get(
+            projectId=self.project_id,
+            jobId=job_reference.get("jobId"),
+            location=job_reference.get("location"),
+        )
+        .execute(num_retries=MAX_RETRIES)
+    )
+    table = job.get("configuration").get("query").get("destinationTable")
+
+    client = bigquery_storage.BigQueryReadClient(credentials=self.credentials)
+    session = client.create_read_session(
+        parent=f"projects/{self.project_id}",
+        read_session=bigquery_storage.types.ReadSession(
+            table=(
+                f"projects/{table.get('projectId')}/datasets/"
+                f"{table.get('datasetId')}/tables/{table.get('tableId')}"
+            ),
+            data_format=bigquery_storage.types.DataFormat.ARROW,
+        ),
+        max_stream_count=self.flags["read_streams"],
+    )
+    logging.info(
+        f"Fetching reviews for sentiment analysis in {len(session.streams)}"
+        " parallel streams..."
+    )
+
+    batches = queue.Queue(maxsize=len(session.streams) * 2)
+    stop = threading.Event()
+
+    def put(batch):
+      # Gives up once the reviews stopped being processed, so that the pool
+      # can be shut down instead of waiting for a full queue forever.
+      while not stop.is_set():
+        try:
+          batches.put(batch, timeout=1)
+          return True
+        except queue.Full:
+          pass
+      return False
+
+    def read_stream(stream_name):
+      try:
+        for page in client.read_rows(stream_name).rows(session).pages:
+          if not put(page.to_arrow().to_pylist()):
+            return
+      finally:
+        put(None)
+
+    last = None
+    with self.tracking_writes() as writes:
+      with concurrent.futures.ThreadPoolExecutor(
+          max_workers=max(len(session.streams), 1)
+      ) as pool:
+        futures = [
+            pool.submit(read_stream, stream.name) for stream in session.streams
+        ]
+
+        try:
+          rows = []
+          remaining_streams = len(futures)
+          while remaining_streams:
+            batch = batches.get()
+            if batch is None:
+              remaining_streams = remaining_streams - 1
+            else:
+              rows.extend(batch)
+              for row in batch:
+                last = max(last or 0, int(row.get("partitionTime")))
+
+            if len(rows) >= BQ_JOBS_QUERY_MAXRESULTS_PER_PAGE or (
+                rows and not remaining_streams
+            ):
+              self.process_sentiments(rows[:BQ_JOBS_QUERY_MAXRESULTS_PER_PAGE])
+              rows = rows[BQ_JOBS_QUERY_MAXRESULTS_PER_PAGE:]
+
+          while rows:
+            self.process_sentiments(rows[:BQ_JOBS_QUERY_MAXRESULTS_PER_PAGE])
+            rows = rows[BQ_JOBS_QUERY_MAXRESULTS_PER_PAGE:]
+        except BaseException:
+          stop.set()
+          while True:
+            try:
+              batches.get_nowait()
+            except queue.Empty:
+              break
+          raise
+
+    for future in futures:
+      future.result()
+
+    # The streams are not ordered, so the watermark can only advance once all
+    # of them have been read and written.
+    if last:
+      self.when_written(writes, self.set_sentiments_watermark, last)
+
+  def get_sentiments_watermark(self):
+    """Returns the first partition of reviews not fully analyzed yet.
+
+    Watermarks recorded by the sentiments_lastrun file of earlier versions are
+    migrated into the state database.
+
+    Returns:
+      The partition time in microseconds, or None if no review was analyzed
+      yet or a full resync was requested.
+    """
+    if self.flags.get("full_resync"):
+      return None
+
+    table = f"{self.project_id}:{DATASET_ID}.reviews"
+    value = self.state.get_watermark("sentiments", table)
+    if value:
+      return int(value)
 
-  def get_sentiments_lastrun(self):
     lastrun_file_path = os.path.join(
         os.path.dirname(__file__), SENTIMENTS_LASTRUN_FILE
     )
-    lastrun = datetime(year=1970, month=1, day=1).date()
-    file_exists = False
+    if not os.path.isfile(lastrun_file_path):
+      return None
+
+    # The file marked the partitions up to the day it was last modified as
+    # analyzed, so the analysis resumes from the next day.
+    lastrun = datetime.fromtimestamp(os.path.getmtime(lastrun_file_path))
+    next_day = datetime.combine(
+        lastrun.date() + timedelta(days=1),
+        datetime.min.time(),
+        tzinfo=timezone.utc,
+    )
+    self.set_sentiments_watermark(int(next_day.timestamp()) * 1000000)
+    watermark = self.get_sentiments_watermark()
+    os.remove(lastrun_file_path)
+    logging.info(
+        f"Migrated the {SENTIMENTS_LASTRUN_FILE} file into {STATE_FILE}."
+    )
 
-    if os.path.isfile(lastrun_file_path):
-      file_exists = True
-      try:
-        lastrun = datetime.fromtimestamp(
-            os.path.getmtime(lastrun_file_path)
-        ).date()
-      except OSError:
-        logging.warn(f"Path {lastrun_file_path} is inaccessible!")
+    return watermark
+
+  def set_sentiments_watermark(self, watermark):
+    """Records the partition the next sentiment analysis starts from.
 
-    return lastrun, file_exists
+    The partitions of today and yesterday may still receive reviews, e.g. from
+    the streaming buffer, so the watermark never goes past the start of
+    yesterday: those partitions are scanned again by the next run, and the
+    reviews already analyzed are skipped by the query.
+
+    Args:
+      watermark: the partition time in microseconds of the last review
+        analyzed.
+    """
+    yesterday = datetime.combine(
+        datetime.now(timezone.utc).date() - timedelta(days=1),
+        datetime.min.time(),
+        tzinfo=timezone.utc,
+    )
+    watermark = min(watermark, int(yesterday.timestamp()) * 1000000)
+    table = f"{self.project_id}:{DATASET_ID}.reviews"
+    self.state.set_watermark("sentiments", table, str(watermark))
 
   def process_sentiments(self, rows):
     sentiments = []
 
-    for row in rows:
+    comments = [row.get("comment") for row in rows]
+    # The comments are stored as they are, along with the fingerprint the
+    # selection of the reviews to analyze compares with the reviews table.
+    texts = [
+        review_text(comment, self.flags.get("review_text", TRANSLATED_TEXT))
+        for comment in comments
+    ]
+    nlp_workers = self.flags.get("nlp_workers", 1)
+    if nlp_workers > 1:
+      # map() returns the annotations in the order of the reviews, whichever
+      # request completes first.
+      with concurrent.futures.ThreadPoolExecutor(
+          max_workers=nlp_workers
+      ) as pool:
+        annotations = list(pool.map(self.annotate_text, texts))
+    else:
+      annotations = [self.annotate_text(text) for text in texts]
+
+    for row, comment, annotated_text in zip(rows, comments, annotations):
       sentiment = {}
-      comment = row.get("f")[0].get("v")
       sentiment["comment"] = comment
-      sentiment["name"] = row.get("f")[1].get("v")
-      sentiment["reviewId"] = row.get("f")[2].get("v")
-      annotated_text = self.annotate_text(comment)
+      sentiment["name"] = row.get("name")
+      sentiment["reviewId"] = row.get("reviewId")
+      sentiment["commentHash"] = row.get("commentHash")
       sentiment["annotation"] = annotated_text
 
       sentiments.append(sentiment)
@@ -347,21 +886,18 @@ class API(object):
         logging.info("Determining topics for the current batch of reviews...")
         self.topic_clustering.determine_topics(sentiments)
 
+    # The syntax tokens are many times larger than the reviews and are only
+    # needed to determine the topics, so only their nouns are kept.
+    if self.flags.get("compact_sentiments"):
+      for sentiment in sentiments:
+        tokens = (sentiment.get("annotation") or {}).pop("tokens", None)
+        if tokens:
+          sentiment["nouns"] = TopicClustering.extract_tokens(tokens, "NOUN")
+
     logging.debug(json.dumps(sentiments, indent=2))
 
     self.to_bigquery(table_name="sentiments", data=sentiments)
 
-  def set_sentiments_lastrun(self):
-    lastrun_file_path = os.path.join(
-        os.path.dirname(__file__), SENTIMENTS_LASTRUN_FILE
-    )
-    current_time = datetime.now().timestamp()
-
-    if os.path.isfile(lastrun_file_path):
-      os.utime(lastrun_file_path, (current_time, current_time))
-    else:
-      os.open(lastrun_file_path, os.O_CREAT)
-
   def annotate_text(self, content):
     if not content:
       return
@@ -370,23 +906,30 @@ class API(object):
     supported_lang = self.language == "en_US"
     classify_text = valid_content and supported_lang
 
+    features = NLP_FEATURE_PROFILES[
+        self.flags.get("nlp_features", DEFAULT_NLP_FEATURES)
+    ]
     body = {
         "document": {"type": "PLAIN_TEXT", "content": content},
-        "features": {
-            "extractSyntax": True,
-            "extractEntities": True,
-            "extractDocumentSentiment": True,
-            "extractEntitySentiment": True,
-            "classifyText": classify_text,
-        },
+        "features": {feature: True for feature in features},
         "encodingType": "UTF8",
     }
+    if self.flags.get("topic_clustering"):
+      body["features"]["extractSyntax"] = True
+    if "classifyText" in features:
+      body["features"]["classifyText"] = classify_text
 
     if self.language:
       body["document"]["language"] = self.language
 
+    if self.annotation_cache:
+      annotation = self.annotation_cache.get(body)
+      if annotation is not None:
+        return annotation
+
+    self.nlp_limiter.acquire()
     try:
-      return (
+      annotation = (
           self.nlp_service.documents()
           .annotateText(body=body)
           .execute(num_retries=MAX_RETRIES)
@@ -394,14 +937,116 @@ class API(object):
     except HttpError as err:
       raise err
 
-  def insights(self, location_id):
+    if self.annotation_cache:
+      self.annotation_cache.put(body, annotation)
+    return annotation
+
+  def location_batches(self, location_ids):
+    """Groups legacy location names into reportInsights batches per account.
+
+    Args:
+      location_ids: a legacy location name or a list of them.
+
+    Returns:
+      A list of (account_id, location_names) tuples, each holding at most
+      LOCATIONS_PER_INSIGHTS_REQUEST locations of the same account.
+    """
+    if isinstance(location_ids, str):
+      location_ids = [location_ids]
+
+    locations_by_account = {}
+    for location_id in location_ids:
+      account_id = re.search(
+          "(accounts/[0-9]+)/locations/[0-9]+", location_id, re.IGNORECASE
+      ).group(1)
+      locations_by_account.setdefault(account_id, []).append(location_id)
+
+    batch_size = LOCATIONS_PER_INSIGHTS_REQUEST
+    return [
+        (account_id, location_names[i : i + batch_size])
+        for account_id, location_names in locations_by_account.items()
+        for i in range(0, len(location_names), batch_size)
+    ]
+
+  def start_times(self, report, location_ids, end_time, days_back):
+    """Groups locations by the start time of the data still to be loaded.
+
+    Locations without a watermark (or all of them when running with
+    --full_resync) start days_back days before end_time. Otherwise, loading
+    resumes from the watermark minus a settle-back window, so that metrics
+    which arrive late are refreshed.
+
+    Args:
+      report: the report type the watermarks are stored for.
+      location_ids: a legacy location name or a list of them.
+      end_time: the end of the time range to load.
+      days_back: the number of days to load when there is no watermark.
+
+    Returns:
+      A dict with lists of legacy location names keyed by start time. Locations
+      which are already up to date are left out.
+    """
+    if isinstance(location_ids, str):
+      location_ids = [location_ids]
+
+    default_start_time = end_time - timedelta(days=days_back)
+    settle_days = self.flags.get("settle_days", SETTLE_DAYS_BACK)
+    locations_by_start_time = {}
+
+    for location_id in location_ids:
+      start_time = default_start_time
+      watermark = self.state.get_watermark(report, location_id)
+      if watermark and not self.flags.get("full_resync"):
+        start_time = max(
+            start_time,
+            datetime.strptime(watermark, "%Y-%m-%dT%H:%M:%SZ")
+            - timedelta(days=settle_days),
+        )
+
+      if start_time < end_time:
+        locations_by_start_time.setdefault(start_time, []).append(location_id)
+      else:
+        logging.debug(f"{report} for {location_id} are up to date.")
+
+    return locations_by_start_time
+
+  def insights(self, location_ids):
     end_time = (datetime.now() - timedelta(days=5)).replace(
         hour=0, minute=0, second=0, microsecond=0
     )
-    start_time = end_time - timedelta(days=INSIGHTS_DAYS_BACK)
+    end_time_string = end_time.strftime("%Y-%m-%dT%H:%M:%SZ")
 
+    data = []
+    location_groups = self.start_times(
+        "insights", location_ids, end_time, INSIGHTS_DAYS_BACK
+    )
+
+    for start_time, location_group in location_groups.items():
+      for account_id, location_names in self.location_batches(location_group):
+        with self.tracking_writes() as writes:
+          batch_data = self.insights_batch(
+              account_id, location_names, start_time, end_time
+          )
+        data = data + batch_data
+
+        # Locations without insights keep their watermark, so that their
+        # history is requested in full again by the next run.
+        reported_names = {line.get("name") for line in batch_data}
+        reported = [name for name in location_names if name in reported_names]
+        if reported:
+          self.when_written(
+              writes,
+              self.state.set_watermark,
+              "insights",
+              reported,
+              end_time_string,
+          )
+
+    return data
+
+  def insights_batch(self, account_id, location_names, start_time, end_time):
     query = {
-        "locationNames": [location_id],
+        "locationNames": location_names,
         "basicRequest": {
             "metricRequests": {
                 "metric": "ALL",
@@ -414,11 +1059,6 @@ class API(object):
         },
     }
 
-    data = []
-    account_id = re.search(
-        "(accounts/[0-9]+)/locations/[0-9]+", location_id, re.IGNORECASE
-    ).group(1)
-
     response_json = (
         self.gmb_service.accounts()
         .locations()
@@ -426,23 +1066,24 @@ class API(object):
         .execute(num_retries=MAX_RETRIES)
     )
 
-    if "locationMetrics" in response_json:
-      for line in response_json.get("locationMetrics"):
-        line["name"] = line.get("locationName")
-        data.append(line)
+    data = []
+    for line in response_json.get("locationMetrics") or []:
+      line["name"] = line.get("locationName")
+      data.append(line)
 
+    reported = {line.get("name") for line in data}
+    for location_id in location_names:
+      if location_id not in reported:
+        logging.warning("No insights reported for %s", location_id)
+
+    if data:
       logging.debug(json.dumps(data, indent=2))
       self.to_bigquery(table_name="insights", data=data)
-    else:
-      logging.warning("No insights reported for %s", location_id)
 
     return data
 
-  def directions(self, location_id):
-    query = {
-        "locationNames": [location_id],
-        "drivingDirectionsRequest": {"numDays": DIRECTIONS_NUM_DAYS},
-    }
+  def directions(self, location_ids):
+    driving_directions_request = {"numDays": DIRECTIONS_NUM_DAYS}
 
     if self.language:
       lang = "en_US"
@@ -451,52 +1092,67 @@ class API(object):
       except UnknownLocaleError:
         logging.warning("Error parsing language code, falling back to en_US.")
 
-      query["drivingDirectionsRequest"]["languageCode"] = str(lang)
+      driving_directions_request["languageCode"] = str(lang)
 
     data = []
-    account_id = re.search(
-        "(accounts/[0-9]+)/locations/[0-9]+", location_id, re.IGNORECASE
-    ).group(1)
 
-    response_json = (
-        self.gmb_service.accounts()
-        .locations()
-        .reportInsights(name=account_id, body=query)
-        .execute(num_retries=MAX_RETRIES)
-    )
+    for account_id, location_names in self.location_batches(location_ids):
+      query = {
+          "locationNames": location_names,
+          "drivingDirectionsRequest": driving_directions_request,
+      }
+
+      response_json = (
+          self.gmb_service.accounts()
+          .locations()
+          .reportInsights(name=account_id, body=query)
+          .execute(num_retries=MAX_RETRIES)
+      )
 
-    if "locationDrivingDirectionMetrics" in response_json:
-      for line in response_json.get("locationDrivingDirectionMetrics"):
+      batch_data = []
+      for line in response_json.get("locationDrivingDirectionMetrics") or []:
         line["name"] = line.get("locationName")
-        data.append(line)
+        batch_data.append(line)
 
-      logging.debug(json.dumps(data, indent=2))
-      self.to_bigquery(table_name="directions", data=data)
+      if batch_data:
+        logging.debug(json.dumps(batch_data, indent=2))
+        self.to_bigquery(table_name="directions", data=batch_data)
+        data = data + batch_data
 
     return data
 
-  def hourly_calls(self, location_id):
-    query = {
-        "locationNames": [location_id],
-        "basicRequest": {
-            "metricRequests": [{
-                "metric": "ACTIONS_PHONE",
-                "options": ["BREAKDOWN_HOUR_OF_DAY"],
-            }],
-            "timeRange": {},
-        },
-    }
-
-    account_id = re.search(
-        "(accounts/[0-9]+)/locations/[0-9]+", location_id, re.IGNORECASE
-    ).group(1)
-
+  def hourly_calls(self, location_ids):
     limit_end_time = (datetime.now() - timedelta(days=5)).replace(
         hour=0, minute=0, second=0, microsecond=0
     )
-    start_time = limit_end_time - timedelta(days=CALLS_DAYS_BACK)
+    limit_end_time_string = limit_end_time.strftime("%Y-%m-%dT%H:%M:%SZ")
 
     data = []
+    location_groups = self.start_times(
+        "hourly_calls", location_ids, limit_end_time, CALLS_DAYS_BACK
+    )
+
+    for start_time, location_group in location_groups.items():
+      for account_id, location_names in self.location_batches(location_group):
+        with self.tracking_writes() as writes:
+          data = data + self.hourly_calls_batch(
+              account_id, location_names, start_time, limit_end_time
+          )
+        self.when_written(
+            writes,
+            self.state.set_watermark,
+            "hourly_calls",
+            location_names,
+            limit_end_time_string,
+        )
+
+    return data
+
+  def hourly_calls_batch(
+      self, account_id, location_names, start_time, limit_end_time
+  ):
+    start_time_strings = []
+    requests = []
 
     while start_time < limit_end_time:
       end_time = start_time + timedelta(days=1)
@@ -504,32 +1160,44 @@ class API(object):
       start_time_string = start_time.strftime("%Y-%m-%dT%H:%M:%SZ")
       end_time_string = end_time.strftime("%Y-%m-%dT%H:%M:%SZ")
 
-      query["basicRequest"]["timeRange"] = {
-          "startTime": start_time_string,
-          "endTime": end_time_string,
+      query = {
+          "locationNames": location_names,
+          "basicRequest": {
+              "metricRequests": [{
+                  "metric": "ACTIONS_PHONE",
+                  "options": ["BREAKDOWN_HOUR_OF_DAY"],
+              }],
+              "timeRange": {
+                  "startTime": start_time_string,
+                  "endTime": end_time_string,
+              },
+          },
       }
 
-      response_json = (
+      start_time_strings.append(start_time_string)
+      requests.append(
           self.gmb_service.accounts()
           .locations()
           .reportInsights(name=account_id, body=query)
-          .execute(num_retries=MAX_RETRIES)
       )
 
-      if "locationMetrics" in response_json:
-        for line in response_json.get("locationMetrics"):
-          line["name"] = f"{line.get('locationName')}/{start_time_string}"
-          if "metricValues" in line:
-            for metric_values in line.get("metricValues"):
-              if "dimensionalValues" in metric_values:
-                for values in metric_values.get("dimensionalValues"):
-                  values["timeDimension"]["timeRange"] = {
-                      "startTime": start_time_string
-                  }
+      start_time = start_time + timedelta(days=1)
 
-          data.append(line)
+    data = []
+    responses = self.execute_requests(requests)
+
+    for start_time_string, response_json in zip(start_time_strings, responses):
+      for line in response_json.get("locationMetrics") or []:
+        line["name"] = f"{line.get('locationName')}/{start_time_string}"
+        if "metricValues" in line:
+          for metric_values in line.get("metricValues"):
+            if "dimensionalValues" in metric_values:
+              for values in metric_values.get("dimensionalValues"):
+                values["timeDimension"]["timeRange"] = {
+                    "startTime": start_time_string
+                }
 
-      start_time = start_time + timedelta(days=1)
+        data.append(line)
 
     if data:
       logging.debug(json.dumps(data, indent=2))
@@ -537,108 +1205,318 @@ class API(object):
 
     return data
 
-  def ensure_dataset_exists(self):
-    if self.dataset_exists:
-      return
-
-    try:
-      self.bq_service.datasets().get(
-          projectId=self.project_id, datasetId=DATASET_ID
-      ).execute(num_retries=MAX_RETRIES)
+  def execute_requests(self, requests):
+    """Executes several independent requests in a single HTTP batch request.
 
-      logging.info(f"Dataset {self.project_id}:{DATASET_ID} already exists.")
+    Requests that fail within the batch, or all of them if the batch request
+    itself fails, are retried one by one.
 
-      self.dataset_exists = True
+    Args:
+      requests: a list of HttpRequest objects built from the same service.
 
-      return
-    except HttpError as err:
-      if err.resp.status != 404:
-        raise
-
-    dataset = {
-        "datasetReference": {
-            "projectId": self.project_id,
-            "datasetId": DATASET_ID,
-        }
-    }
+    Returns:
+      The list of responses, in the same order as the requests.
+    """
+    responses = [None] * len(requests)
 
-    self.bq_service.datasets().insert(
-        projectId=self.project_id, body=dataset
-    ).execute(num_retries=MAX_RETRIES)
+    if self.flags.get("batch_requests", True) and len(requests) > 1:
 
-    self.dataset_exists = True
-
-  def ensure_table_exists(self, table_name):
-    if self.existing_tables.get(table_name):
-      return
+      def callback(request_id, response, exception):
+        if exception:
+          logging.debug(
+              f"Request {request_id} failed within the batch: {exception}"
+          )
+        else:
+          responses[int(request_id)] = response
 
-    try:
-      self.bq_service.tables().get(
-          projectId=self.project_id, datasetId=DATASET_ID, tableId=table_name
-      ).execute(num_retries=MAX_RETRIES)
+      for i in range(0, len(requests), MAX_REQUESTS_PER_BATCH):
+        batch = self.gmb_service.new_batch_http_request(callback=callback)
+        for j, request in enumerate(requests[i : i + MAX_REQUESTS_PER_BATCH]):
+          batch.add(request, request_id=str(i + j))
+        try:
+          batch.execute()
+        except (HttpError, httplib2.HttpLib2Error, OSError) as err:
+          logging.warning(
+              f"Batch request failed, retrying requests one by one: {err}"
+          )
 
-      logging.info(
-          f"Table {self.project_id}:{DATASET_ID}.{table_name} already exists."
+    for i, request in enumerate(requests):
+      if responses[i] is None:
+        responses[i] = request.execute(num_retries=MAX_RETRIES)
+
+    return responses
+
+  def setup_writes(self, sink):
+    """Sets up where and how the retrieved rows are written.
+
+    Args:
+      sink: the Sink to write the rows into.
+    """
+    self.sink = sink
+    self.write_lock = threading.Lock()
+    self.write_queue = None
+    self.writers = []
+    self.write_failures = 0
+    self.write_trackers = threading.local()
+    self.deferred_writes = {}
+    self.buffer_lock = threading.Lock()
+    self.write_buffers = {}
+    self.buffer_timer = None
+    self.buffer_timer_stop = threading.Event()
+
+    if self.flags.get("writers"):
+      self.start_writers(
+          self.flags["writers"], self.flags.get("write_queue_size", 1)
+      )
+    if self.flags.get("bq_buffer_rows"):
+      self.buffer_timer = threading.Thread(
+          target=self.write_old_buffers, daemon=True
       )
+      self.buffer_timer.start()
+
+  def start_writers(self, num_writers, queue_size):
+    """Starts the threads writing rows into BigQuery in the background.
+
+    Fetching methods then only queue their rows, so that BigQuery latency does
+    not delay the next Google My Business request. The queue is bounded, so
+    fetching blocks whenever the writers fall behind.
+
+    Args:
+      num_writers: the number of writer threads.
+      queue_size: the maximum number of batches of rows waiting to be written.
+    """
+    self.write_queue = queue.Queue(maxsize=queue_size)
+    self.writers = [
+        threading.Thread(target=self.write_rows, daemon=True)
+        for _ in range(num_writers)
+    ]
+    for writer in self.writers:
+      writer.start()
 
-      self.existing_tables[table_name] = True
+  def write_rows(self):
+    while True:
+      item = self.write_queue.get()
+      if item is None:
+        self.write_queue.task_done()
+        return
 
+      table_name, data, future = item
+      try:
+        self.write_now(table_name, data, future)
+      finally:
+        self.write_queue.task_done()
+
+  def write_now(self, table_name, data, future):
+    """Inserts rows, reporting failures through the future instead of raising.
+
+    Args:
+      table_name: the table to insert the rows into.
+      data: the rows to insert.
+      future: the future to resolve once the rows have been written.
+    """
+    try:
+      self.sink.write(table_name, data)
+      future.set_result(None)
+    except Exception as err:  # pylint: disable=broad-except
+      with self.write_lock:
+        self.write_failures = self.write_failures + 1
+      logging.error(
+          f"Failed to write {len(data)} rows into table {table_name}:"
+          f" {str(err)}"
+      )
+      future.set_exception(err)
+
+  def flush(self):
+    """Waits until all the buffered, queued and deferred rows are written."""
+    self.flush_buffers()
+    if self.write_queue:
+      self.write_queue.join()
+
+    with self.write_lock:
+      deferred_writes = self.deferred_writes
+      self.deferred_writes = {}
+
+    for table_name, err in self.sink.flush().items():
+      if err:
+        with self.write_lock:
+          self.write_failures = self.write_failures + 1
+      for future in deferred_writes.pop(table_name, []):
+        if err:
+          future.set_exception(err)
+        else:
+          future.set_result(None)
+
+  def close(self):
+    """Writes all the pending rows and stops the writer threads."""
+    if self.buffer_timer:
+      self.buffer_timer_stop.set()
+      self.buffer_timer.join()
+      self.buffer_timer = None
+
+    self.flush()
+    if self.write_queue:
+      for _ in self.writers:
+        self.write_queue.put(None)
+      for writer in self.writers:
+        writer.join()
+
+      self.write_queue = None
+      self.writers = []
+
+    self.sink.close()
+    if self.annotation_cache:
+      self.annotation_cache.close()
+    if self.topic_clustering:
+      self.topic_clustering.close()
+
+  @contextlib.contextmanager
+  def tracking_writes(self):
+    """Collects the writes issued by the current thread within the block.
+
+    Yields:
+      The list of futures of the writes, to be passed to when_written.
+    """
+    if not hasattr(self.write_trackers, "stack"):
+      self.write_trackers.stack = []
+
+    writes = []
+    self.write_trackers.stack.append(writes)
+    try:
+      yield writes
+    finally:
+      self.write_trackers.stack.remove(writes)
+
+  def when_written(self, writes, callback, *args):
+    """Calls callback(*args) once all the given writes have succeeded.
+
+    Args:
+      writes: the list of futures collected with tracking_writes.
+      callback: the function to call, e.g. to advance a watermark.
+      *args: the arguments to call the function with.
+    """
+    if not writes:
+      callback(*args)
       return
-    except HttpError as err:
-      if err.resp.status != 404:
-        raise
-
-    table = {
-        "schema": {"fields": self.schemas.get(table_name)},
-        "tableReference": {
-            "projectId": self.project_id,
-            "datasetId": DATASET_ID,
-            "tableId": table_name,
-        },
-        "timePartitioning": {"type": "DAY"},
-    }
 
-    self.bq_service.tables().insert(
-        projectId=self.project_id, datasetId=DATASET_ID, body=table
-    ).execute(num_retries=MAX_RETRIES)
+    lock = threading.Lock()
+    remaining = [len(writes)]
+
+    def done(_):
+      with lock:
+        remaining[0] = remaining[0] - 1
+        if remaining[0]:
+          return
+      if not any(write.exception() for write in writes):
+        callback(*args)
 
-    self.existing_tables[table_name] = True
+    for write in writes:
+      write.add_done_callback(done)
 
   def to_bigquery(self, table_name, data=[]):
+    future = concurrent.futures.Future()
+
     if not data:
+      future.set_result(None)
+      return future
+
+    for writes in getattr(self.write_trackers, "stack", []):
+      writes.append(future)
+
+    if self.sink.deferred:
+      # Deferred sinks only store their rows when flushed, so the futures are
+      # resolved then.
+      self.sink.write(table_name, data)
+      with self.write_lock:
+        self.deferred_writes.setdefault(table_name, []).append(future)
+    elif self.flags.get("bq_buffer_rows"):
+      self.buffer_rows(table_name, data, future)
+    elif self.write_queue:
+      self.write_queue.put((table_name, data, future))
+    else:
+      self.sink.write(table_name, data)
+      future.set_result(None)
+
+    return future
+
+  def buffer_rows(self, table_name, data, future):
+    """Collects rows per table, across locations, into larger writes.
+
+    A table's buffer is written once it holds --bq_buffer_rows rows or
+    WRITE_BUFFER_MAX_BYTES bytes, once its oldest rows are older than
+    --bq_buffer_seconds, and always when the API is flushed or closed.
+
+    Args:
+      table_name: the table the rows are meant for.
+      data: the rows to buffer.
+      future: the future to resolve once the rows have been written.
+    """
+    num_bytes = sum(len(json.dumps(line)) for line in data)
+    max_age = self.flags.get("bq_buffer_seconds", WRITE_BUFFER_MAX_SECONDS)
+    now = time.monotonic()
+
+    with self.buffer_lock:
+      buffer = self.write_buffers.setdefault(
+          table_name, {"rows": [], "bytes": 0, "futures": [], "since": now}
+      )
+      buffer["rows"].extend(data)
+      buffer["bytes"] = buffer["bytes"] + num_bytes
+      buffer["futures"].append(future)
+
+      full_tables = [
+          name
+          for name, buffer in self.write_buffers.items()
+          if len(buffer["rows"]) >= self.flags["bq_buffer_rows"]
+          or buffer["bytes"] >= WRITE_BUFFER_MAX_BYTES
+          or now - buffer["since"] >= max_age
+      ]
+
+    for name in full_tables:
+      self.flush_buffer(name)
+
+  def write_old_buffers(self):
+    """Writes the buffers whose oldest rows are older than --bq_buffer_seconds.
+
+    Runs in its own thread until the API is closed, so that buffered rows are
+    written in time even when no other rows arrive for their table.
+    """
+    max_age = self.flags.get("bq_buffer_seconds", WRITE_BUFFER_MAX_SECONDS)
+    while not self.buffer_timer_stop.wait(WRITE_BUFFER_CHECK_SECONDS):
+      now = time.monotonic()
+      with self.buffer_lock:
+        old_tables = [
+            name
+            for name, buffer in self.write_buffers.items()
+            if now - buffer["since"] >= max_age
+        ]
+
+      for name in old_tables:
+        self.flush_buffer(name)
+
+  def flush_buffer(self, table_name):
+    with self.buffer_lock:
+      buffer = self.write_buffers.pop(table_name, None)
+
+    if not buffer:
       return
 
-    self.ensure_dataset_exists()
-    self.ensure_table_exists(table_name)
-
-    rows = [{"json": line, "insertId": line.get("name")} for line in data]
+    def resolve(write):
+      for future in buffer["futures"]:
+        if write.exception():
+          future.set_exception(write.exception())
+        else:
+          future.set_result(None)
 
-    chunk_size = BQ_TABLEDATA_INSERTALL_BATCHSIZE
-    chunked_rows = [
-        rows[i * chunk_size : (i + 1) * chunk_size]
-        for i in range((len(rows) + chunk_size - 1) // chunk_size)
-    ]
+    write = concurrent.futures.Future()
+    write.add_done_callback(resolve)
 
-    for chunk in chunked_rows:
-      logging.info(
-          f"Inserting {len(chunk)} rows into table"
-          f" {self.project_id}:{DATASET_ID}.{table_name}."
-      )
+    if self.write_queue:
+      self.write_queue.put((table_name, buffer["rows"], write))
+    else:
+      self.write_now(table_name, buffer["rows"], write)
 
-      data_chunk = {"rows": chunk, "ignoreUnknownValues": True}
+  def flush_buffers(self):
+    with self.buffer_lock:
+      table_names = list(self.write_buffers)
 
-      result = (
-          self.bq_service.tabledata()
-          .insertAll(
-              projectId=self.project_id,
-              datasetId=DATASET_ID,
-              tableId=table_name,
-              body=data_chunk,
-          )
-          .execute(num_retries=MAX_RETRIES)
-      )
-      if "insertErrors" in result:
-        logging.error(
-            "Errors found in the BigQuery insert operation. Details below."
-        )
-        logging.error(result["insertErrors"])
+    for table_name in table_names:
+      self.flush_buffer(table_name)
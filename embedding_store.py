@@ -0,0 +1,192 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+VECTORS_FILE = "vectors.npy"
+INDEX_FILE = "index.db"
+# SQLite limits the number of parameters of a statement.
+KEYS_PER_QUERY = 500
+
+
+class EmbeddingStore(object):
+  """Persists sentence embeddings between runs in a memory-mapped matrix.
+
+  Every text is keyed by its SHA-256 hash. An SQLite index maps the keys to
+  the rows of the matrix, and the least recently used rows are reused once the
+  matrix is full. Embeddings are only comparable when they come from the same
+  model, so every model URL gets its own directory, and the directories of
+  other models are deleted.
+  """
+
+  def __init__(self, directory, model_url, max_rows, dtype=np.float16):
+    version = hashlib.sha256(model_url.encode("utf-8")).hexdigest()[:16]
+    os.makedirs(os.path.join(directory, version), exist_ok=True)
+    for name in os.listdir(directory):
+      if name != version and os.path.isdir(os.path.join(directory, name)):
+        logging.info(f"Deleting the embeddings of another model in {name}.")
+        shutil.rmtree(os.path.join(directory, name))
+
+    self.directory = os.path.join(directory, version)
+    self.max_rows = max_rows
+    self.dtype = dtype
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+
+    self.connection = sqlite3.connect(
+        os.path.join(self.directory, INDEX_FILE), check_same_thread=False
+    )
+    with self.lock, self.connection:
+      self.connection.execute("""
+          CREATE TABLE IF NOT EXISTS embeddings (
+            key TEXT NOT NULL PRIMARY KEY,
+            row INTEGER NOT NULL UNIQUE,
+            used REAL NOT NULL
+          )""")
+      self.connection.execute(
+          "CREATE INDEX IF NOT EXISTS embeddings_used ON embeddings (used)"
+      )
+
+    self.vectors = None
+    vectors_path = os.path.join(self.directory, VECTORS_FILE)
+    if os.path.exists(vectors_path):
+      self.vectors = np.lib.format.open_memmap(vectors_path, mode="r+")
+      if self.vectors.shape[0] != max_rows or self.vectors.dtype != dtype:
+        logging.info("Resetting the embedding store to its new size.")
+        self.vectors = None
+        with self.lock, self.connection:
+          self.connection.execute("DELETE FROM embeddings")
+
+  @staticmethod
+  def key(text):
+    """Returns the key of a text, i.e. its SHA-256 hex digest."""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+  def embed(self, texts, encoder):
+    """Returns the embeddings of texts, only encoding the ones not stored yet.
+
+    Args:
+      texts: a list of strings.
+      encoder: a function returning the embeddings of a list of strings.
+
+    Returns:
+      A float32 numpy matrix with the embedding of each text.
+    """
+    keys = [self.key(text) for text in texts]
+    unique_keys = list(dict.fromkeys(keys))
+
+    with self.lock:
+      rows = {}
+      for start in range(0, len(unique_keys), KEYS_PER_QUERY):
+        chunk = unique_keys[start : start + KEYS_PER_QUERY]
+        rows.update(
+            self.connection.execute(
+                "SELECT key, row FROM embeddings WHERE key IN"
+                f" ({', '.join('?' * len(chunk))})",
+                chunk,
+            ).fetchall()
+        )
+      with self.connection:
+        self.connection.executemany(
+            "UPDATE embeddings SET used = ? WHERE key = ?",
+            [(time.time(), key) for key in rows],
+        )
+      embeddings = {
+          key: np.asarray(self.vectors[row], dtype=np.float32)
+          for key, row in rows.items()
+      }
+
+    missing = {
+        key: text for key, text in zip(keys, texts) if key not in embeddings
+    }
+    self.hits = self.hits + len(texts) - len(missing)
+    self.misses = self.misses + len(missing)
+    if missing:
+      # The new embeddings are rounded like the stored ones, so that the
+      # result does not depend on which texts were already stored.
+      encoded = np.asarray(
+          encoder(list(missing.values())), dtype=self.dtype
+      ).astype(np.float32)
+      embeddings.update(zip(missing, encoded))
+      self.store(list(missing), encoded)
+
+    return np.stack([embeddings[key] for key in keys])
+
+  def store(self, keys, vectors):
+    """Stores embeddings, evicting the least recently used ones if needed.
+
+    Args:
+      keys: the keys of the texts.
+      vectors: a matrix with the embedding of each text.
+    """
+    keys = keys[-self.max_rows :]
+    vectors = vectors[-self.max_rows :]
+
+    with self.lock:
+      if self.vectors is None:
+        self.vectors = np.lib.format.open_memmap(
+            os.path.join(self.directory, VECTORS_FILE),
+            mode="w+",
+            dtype=self.dtype,
+            shape=(self.max_rows, vectors.shape[1]),
+        )
+
+      used_rows = {
+          row
+          for (row,) in self.connection.execute("SELECT row FROM embeddings")
+      }
+      free_rows = [row for row in range(self.max_rows) if row not in used_rows]
+      if len(free_rows) < len(keys):
+        # Evicting a tenth of the store at once keeps evictions infrequent.
+        evicted = self.connection.execute(
+            "SELECT key, row FROM embeddings ORDER BY used LIMIT ?",
+            (len(keys) - len(free_rows) + self.max_rows // 10,),
+        ).fetchall()
+        with self.connection:
+          self.connection.executemany(
+              "DELETE FROM embeddings WHERE key = ?",
+              [(key,) for key, _ in evicted],
+          )
+        free_rows.extend(row for _, row in evicted)
+        logging.debug(f"Evicted {len(evicted)} embeddings from the store.")
+
+      rows = free_rows[: len(keys)]
+      self.vectors[rows] = vectors
+      # The vectors are on disk before the index points at them.
+      self.vectors.flush()
+      with self.connection:
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO embeddings (key, row, used)"
+            " VALUES (?, ?, ?)",
+            [(key, row, time.time()) for key, row in zip(keys, rows)],
+        )
+
+  def close(self):
+    """Logs the hit rate of the store and closes it."""
+    lookups = self.hits + self.misses
+    if lookups:
+      logging.info(
+          f"Embedding store: {self.hits} hits out of {lookups} lookups"
+          f" ({self.hits * 100 // lookups}%)."
+      )
+    self.connection.close()
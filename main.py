@@ -13,10 +13,28 @@
 # limitations under the License.
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import contextlib
 import logging
 import sys
 
+from api import ANNOTATION_CACHE_MB
 from api import API
+from api import BIGQUERY_SINK
+from api import BOTH_TEXTS
+from api import DEFAULT_NLP_FEATURES
+from api import DUCKDB_SINK
+from api import LOAD_JOB_SINK
+from api import LOCATIONS_PER_INSIGHTS_REQUEST
+from api import NLP_FEATURE_PROFILES
+from api import NLP_REQUESTS_PER_MINUTE
+from api import ORIGINAL_TEXT
+from api import PARQUET_SINK
+from api import SETTLE_DAYS_BACK
+from api import STREAMING_SINK
+from api import TRANSLATED_TEXT
+from api import WRITE_BUFFER_MAX_SECONDS
+import topic_clustering
 
 INSIGHTS = "insights"
 REVIEWS = "reviews"
@@ -24,6 +42,34 @@ SENTIMENT = "sentiment"
 DIRECTIONS = "directions"
 HOURLY_CALLS = "hourly_calls"
 TOPIC_CLUSTERING = "topic_clustering"
+WORKERS = "workers"
+BATCH_REQUESTS = "batch_requests"
+SETTLE_DAYS = "settle_days"
+INCREMENTAL_REVIEWS = "incremental_reviews"
+FULL_RESYNC = "full_resync"
+RESUME = "resume"
+WRITERS = "writers"
+WRITE_QUEUE_SIZE = "write_queue_size"
+BQ_SINK = "bq_sink"
+BQ_INFLIGHT = "bq_inflight"
+BQ_BUFFER_ROWS = "bq_buffer_rows"
+BQ_BUFFER_SECONDS = "bq_buffer_seconds"
+SINK = "sink"
+SINK_PATH = "sink_path"
+READ_STREAMS = "read_streams"
+NLP_WORKERS = "nlp_workers"
+NLP_RPM = "nlp_rpm"
+NLP_CACHE_MB = "nlp_cache_mb"
+NLP_FEATURES = "nlp_features"
+COMPACT_SENTIMENTS = "compact_sentiments"
+REVIEW_TEXT = "review_text"
+MODEL_CACHE_DIR = "model_cache_dir"
+MIN_CLUSTERS = "min_clusters"
+MAX_CLUSTERS = "max_clusters"
+CLUSTERS_PATIENCE = "clusters_patience"
+CLUSTER_SCORE = "cluster_score"
+CLUSTER_SCORE_THRESHOLD = "cluster_score_threshold"
+EMBEDDING_STORE_ROWS = "embedding_store_rows"
 
 
 class Alligator:
@@ -32,6 +78,9 @@ class Alligator:
   def sentiment_only(cls, project_id, language, flags):
     api = API(project_id, language, flags)
     api.sentiments()
+    api.close()
+
+    return api.write_failures
 
   @classmethod
   def for_account_and_location(
@@ -41,83 +90,170 @@ class Alligator:
 
     location_name = f"locations/{location_id}"
     account_name = f"accounts/{account_id}"
-    legacy_location_name = f"accounts/{account_id}/locations/{location_id}"
-
-    api.locations(account_id=account_name, location_id=location_name)
-
-    if flags[INSIGHTS]:
-      api.insights(legacy_location_name)
-    if flags[DIRECTIONS]:
-      api.directions(legacy_location_name)
-    if flags[HOURLY_CALLS]:
-      api.hourly_calls(legacy_location_name)
-    if flags[REVIEWS]:
-      api.reviews(legacy_location_name)
+
+    api.state.start_run(resume=flags[RESUME])
+    locations = api.locations(
+        account_id=account_name, location_id=location_name
+    )
+
+    with cls.executor(flags) as executor:
+      failures = cls.process_locations(
+          api, account_name, locations, flags, executor
+      )
+
     if flags[SENTIMENT]:
       api.sentiments()
 
+    return cls.finish_run(api, failures)
+
   @classmethod
   def for_account(cls, project_id, account_id, language, flags):
     account_name = f"accounts/{account_id}"
 
     api = API(project_id, language, flags)
+    api.state.start_run(resume=flags[RESUME])
     locations = api.locations(account_id=account_name)
-    num_locations = len(locations)
-    loc_ctr = 1
-
-    for location in locations:
-      logging.info(f"Processing location {loc_ctr} of {num_locations}...")
 
-      legacy_location_name = f"{account_name}/{location.get('name')}"
-
-      if flags[INSIGHTS]:
-        api.insights(legacy_location_name)
-      if flags[DIRECTIONS]:
-        api.directions(legacy_location_name)
-      if flags[HOURLY_CALLS]:
-        api.hourly_calls(legacy_location_name)
-      if flags[REVIEWS]:
-        api.reviews(legacy_location_name)
-
-      loc_ctr = loc_ctr + 1
+    with cls.executor(flags) as executor:
+      failures = cls.process_locations(
+          api, account_name, locations, flags, executor
+      )
 
     if flags[SENTIMENT]:
       api.sentiments()
 
+    return cls.finish_run(api, failures)
+
   @classmethod
   def all(cls, project_id, language, flags):
     api = API(project_id, language, flags)
+    api.state.start_run(resume=flags[RESUME])
     accounts = api.accounts()
     num_accounts = len(accounts)
     ac_ctr = 1
+    failures = 0
+
+    with cls.executor(flags) as executor:
+      for account in accounts:
+        logging.info(f"Processing account {ac_ctr} of {num_accounts}...")
+
+        account_name = account.get("name")
+        locations = api.locations(account_name)
+        failures = failures + cls.process_locations(
+            api, account_name, locations, flags, executor
+        )
+
+        ac_ctr = ac_ctr + 1
+
+    if flags[SENTIMENT]:
+      api.sentiments()
 
-    for account in accounts:
-      logging.info(f"Processing account {ac_ctr} of {num_accounts}...")
+    return cls.finish_run(api, failures)
 
-      account_name = account.get("name")
-      locations = api.locations(account_name)
-      num_locations = len(locations)
-      loc_ctr = 1
+  @classmethod
+  def finish_run(cls, api, failures):
+    api.close()
+    failures = failures + api.write_failures
+    if failures:
+      logging.warning(
+          f"{failures} units failed. Run again with --resume to retry them"
+          " without repeating the completed ones."
+      )
+    else:
+      api.state.finish_run()
 
-      for location in locations:
-        logging.info(f"Processing location {loc_ctr} of {num_locations}...")
+    return failures
 
-        legacy_location_name = f"{account_name}/{location.get('name')}"
+  @classmethod
+  def executor(cls, flags):
+    if flags[WORKERS] > 1:
+      return ThreadPoolExecutor(max_workers=flags[WORKERS])
+    return contextlib.nullcontext()
 
-        if flags[INSIGHTS]:
-          api.insights(legacy_location_name)
-        if flags[DIRECTIONS]:
-          api.directions(legacy_location_name)
-        if flags[HOURLY_CALLS]:
-          api.hourly_calls(legacy_location_name)
-        if flags[REVIEWS]:
-          api.reviews(legacy_location_name)
+  @classmethod
+  def process_locations(cls, api, account_name, locations, flags, executor):
+    # Insights, directions and hourly calls accept several locations of the
+    # same account per request, while reviews are listed one location at a
+    # time.
+    batched_reports = {
+        INSIGHTS: api.insights,
+        DIRECTIONS: api.directions,
+        HOURLY_CALLS: api.hourly_calls,
+    }
+    location_names = [
+        f"{account_name}/{location.get('name')}" for location in locations
+    ]
+    num_locations = len(location_names)
+    batch_size = LOCATIONS_PER_INSIGHTS_REQUEST
+
+    batches = []
+    for i in range(0, num_locations, batch_size):
+      batch = location_names[i : i + batch_size]
+      units = []
+      # Units completed by an interrupted run are skipped with --resume.
+      for report, method in batched_reports.items():
+        pending = [
+            location_name
+            for location_name in batch
+            if flags[report] and not api.state.is_done(report, location_name)
+        ]
+        if pending:
+          units.append((report, method, pending))
+      if flags[REVIEWS]:
+        for location_name in batch:
+          if not api.state.is_done(REVIEWS, location_name):
+            units.append((REVIEWS, api.reviews, [location_name]))
+      batches.append((i, units))
+
+    if not executor:
+      for i, units in batches:
+        logging.info(
+            f"Processing locations {i + 1} to"
+            f" {min(i + batch_size, num_locations)} of {num_locations}..."
+        )
+        for report, method, unit_locations in units:
+          cls.run_unit(api, report, method, unit_locations)
+      return 0
+
+    # Every unit of work is independent, so a failing unit is logged and does
+    # not abort the rest of the account. The failures are counted instead, and
+    # make the run exit with a failure status.
+    futures = {}
+    for _, units in batches:
+      for report, method, unit_locations in units:
+        future = executor.submit(
+            cls.run_unit, api, report, method, unit_locations
+        )
+        futures[future] = (report, unit_locations)
+
+    failures = 0
+    for future in as_completed(futures):
+      report, unit_locations = futures[future]
+      try:
+        future.result()
+      except Exception as err:  # pylint: disable=broad-except
+        failures = failures + 1
+        logging.error(
+            f"Failed to process {report} for"
+            f" location_id={', '.join(unit_locations)} with error: {str(err)}"
+        )
+
+    logging.info(
+        f"Processed {num_locations} locations of {account_name} with"
+        f" {len(futures) - failures} of {len(futures)} units succeeding."
+    )
 
-        loc_ctr = loc_ctr + 1
-      ac_ctr = ac_ctr + 1
+    return failures
 
-    if flags[SENTIMENT]:
-      api.sentiments()
+  @classmethod
+  def run_unit(cls, api, report, method, location_names):
+    with api.tracking_writes() as writes:
+      if report == REVIEWS:
+        method(location_names[0])
+      else:
+        method(location_names)
+
+    api.when_written(writes, api.state.mark_done, report, location_names)
 
 
 def main(argv):
@@ -193,6 +329,277 @@ def main(argv):
       ),
       action="store_true",
   )
+  parser.add_argument(
+      "--workers",
+      type=int,
+      default=1,
+      help=(
+          "the number of locations and report types to process concurrently"
+          " (defaults to 1, i.e. one at a time)"
+      ),
+  )
+  parser.add_argument(
+      "--no_batch_requests",
+      help=(
+          "send the daily hourly calls requests one at a time instead of in a"
+          " single HTTP batch request"
+      ),
+      action="store_true",
+  )
+  parser.add_argument(
+      "--settle_days",
+      type=int,
+      default=SETTLE_DAYS_BACK,
+      help=(
+          "the number of already loaded days of insights and hourly calls to"
+          " load again, to pick up late metrics (defaults to"
+          f" {SETTLE_DAYS_BACK})"
+      ),
+  )
+  parser.add_argument(
+      "--incremental_reviews",
+      help=(
+          "only retrieve the reviews updated since the previous run, instead of"
+          " all the reviews (replies to older reviews and deleted reviews are"
+          " not picked up)"
+      ),
+      action="store_true",
+  )
+  parser.add_argument(
+      "--full_resync",
+      help=(
+          "ignore what previous runs have loaded and retrieve the full history"
+          " of insights, hourly calls and reviews again, and scan all the"
+          " reviews for the sentiment analysis, which only analyzes the ones"
+          " not analyzed yet"
+      ),
+      action="store_true",
+  )
+  parser.add_argument(
+      "--resume",
+      help=(
+          "resume an interrupted run, skipping the locations and report types"
+          " which were already completed"
+      ),
+      action="store_true",
+  )
+  parser.add_argument(
+      "--bq_writers",
+      type=int,
+      default=0,
+      help=(
+          "the number of background threads writing rows into BigQuery, so"
+          " that fetching does not wait for the writes (defaults to 0, i.e."
+          " rows are written as soon as they are fetched)"
+      ),
+  )
+  parser.add_argument(
+      "--write_queue_size",
+      type=int,
+      default=100,
+      help=(
+          "the maximum number of batches of rows waiting for the BigQuery"
+          " writers before fetching is paused (defaults to 100)"
+      ),
+  )
+  parser.add_argument(
+      "--bq_inflight",
+      type=int,
+      default=1,
+      help=(
+          "the number of concurrent insert requests when writing rows into a"
+          " BigQuery table (defaults to 1)"
+      ),
+  )
+  parser.add_argument(
+      "--bq_buffer_rows",
+      type=int,
+      default=0,
+      help=(
+          "collect the rows of each BigQuery table across locations and write"
+          " them once this many rows are waiting (defaults to 0, i.e. rows"
+          " are written as soon as they are fetched)"
+      ),
+  )
+  parser.add_argument(
+      "--bq_buffer_seconds",
+      type=int,
+      default=WRITE_BUFFER_MAX_SECONDS,
+      help=(
+          "the maximum time rows wait in a --bq_buffer_rows buffer before they"
+          f" are written (defaults to {WRITE_BUFFER_MAX_SECONDS})"
+      ),
+  )
+  parser.add_argument(
+      "--bq_sink",
+      choices=[STREAMING_SINK, LOAD_JOB_SINK],
+      default=STREAMING_SINK,
+      help=(
+          "how rows are written into BigQuery: streamed as they are fetched,"
+          " or staged locally and loaded with one load job per table at the"
+          f" end of the run (defaults to {STREAMING_SINK})"
+      ),
+  )
+  parser.add_argument(
+      "--sink",
+      choices=[BIGQUERY_SINK, PARQUET_SINK, DUCKDB_SINK],
+      default=BIGQUERY_SINK,
+      help=(
+          "where to store the retrieved data: BigQuery, local Parquet files or"
+          f" a local DuckDB database (defaults to {BIGQUERY_SINK})"
+      ),
+  )
+  parser.add_argument(
+      "--sink_path",
+      type=str,
+      help=(
+          "the directory of the Parquet files (defaults to alligator) or the"
+          " DuckDB database file (defaults to alligator.duckdb)"
+      ),
+  )
+  parser.add_argument(
+      "--read_streams",
+      type=int,
+      default=0,
+      help=(
+          "read the reviews for sentiment analysis with the BigQuery Storage"
+          " Read API, in up to this many parallel streams (defaults to 0, i.e."
+          " the reviews are paged through the query results)"
+      ),
+  )
+  parser.add_argument(
+      "--nlp_workers",
+      type=int,
+      default=1,
+      help=(
+          "the number of reviews annotated concurrently by the Natural Language"
+          " API during the sentiment analysis (defaults to 1)"
+      ),
+  )
+  parser.add_argument(
+      "--nlp_rpm",
+      type=int,
+      default=NLP_REQUESTS_PER_MINUTE,
+      help=(
+          "the maximum number of Natural Language API requests per minute,"
+          " matching the project's quota, or 0 for no limit (defaults to"
+          f" {NLP_REQUESTS_PER_MINUTE})"
+      ),
+  )
+  parser.add_argument(
+      "--nlp_cache_mb",
+      type=int,
+      default=ANNOTATION_CACHE_MB,
+      help=(
+          "the maximum size of the local cache of Natural Language API"
+          " annotations, which avoids annotating unchanged reviews again, or 0"
+          f" to disable it (defaults to {ANNOTATION_CACHE_MB})"
+      ),
+  )
+  parser.add_argument(
+      "--nlp_features",
+      choices=list(NLP_FEATURE_PROFILES),
+      default=DEFAULT_NLP_FEATURES,
+      help=(
+          "the text annotations requested from the Natural Language API:"
+          " everything, everything but the syntax, only the document sentiment"
+          " or only the entities and their sentiment. The syntax is always"
+          " requested when topic clustering is enabled (defaults to"
+          f" {DEFAULT_NLP_FEATURES})"
+      ),
+  )
+  parser.add_argument(
+      "--compact_sentiments",
+      help=(
+          "store the nouns of the reviews instead of their syntax tokens in"
+          " the sentiments table"
+      ),
+      action="store_true",
+  )
+  parser.add_argument(
+      "--review_text",
+      choices=[TRANSLATED_TEXT, ORIGINAL_TEXT, BOTH_TEXTS],
+      default=TRANSLATED_TEXT,
+      help=(
+          "which text of the reviews translated by Google to analyze: the"
+          " translation, the original text or both of them (defaults to"
+          f" {TRANSLATED_TEXT})"
+      ),
+  )
+  parser.add_argument(
+      "--model_cache_dir",
+      type=str,
+      help=(
+          "the directory the topic clustering model is downloaded into once"
+          " and loaded from afterwards (defaults to models)"
+      ),
+  )
+  parser.add_argument(
+      "--min_clusters",
+      type=int,
+      default=topic_clustering.MIN_CLUSTERS,
+      help=(
+          "the smallest number of topics to try when clustering the reviews"
+          f" (defaults to {topic_clustering.MIN_CLUSTERS})"
+      ),
+  )
+  parser.add_argument(
+      "--max_clusters",
+      type=int,
+      default=topic_clustering.MAX_CLUSTERS,
+      help=(
+          "the largest number of topics to try when clustering the reviews"
+          f" (defaults to {topic_clustering.MAX_CLUSTERS})"
+      ),
+  )
+  parser.add_argument(
+      "--clusters_patience",
+      type=int,
+      default=topic_clustering.CLUSTERS_PATIENCE,
+      help=(
+          "stop trying more topics once this many numbers of topics in a row"
+          " have not clustered the reviews better, or 0 to try all of them"
+          f" (defaults to {topic_clustering.CLUSTERS_PATIENCE})"
+      ),
+  )
+  parser.add_argument(
+      "--cluster_score",
+      choices=[
+          topic_clustering.SILHOUETTE,
+          topic_clustering.CALINSKI_HARABASZ,
+          topic_clustering.DAVIES_BOULDIN,
+      ],
+      default=topic_clustering.SILHOUETTE,
+      help=(
+          "how batches of more than --cluster_score_threshold reviews are"
+          " scored when choosing the number of topics: the silhouette"
+          " coefficient of a sample of the reviews, the Calinski-Harabasz"
+          " index or the Davies-Bouldin index (defaults to"
+          f" {topic_clustering.SILHOUETTE})"
+      ),
+  )
+  parser.add_argument(
+      "--cluster_score_threshold",
+      type=int,
+      default=topic_clustering.SCORE_THRESHOLD,
+      help=(
+          "the largest batch of reviews whose clusters are scored with the"
+          " silhouette coefficient of all of them, and the size of the sample"
+          " of larger batches (defaults to"
+          f" {topic_clustering.SCORE_THRESHOLD})"
+      ),
+  )
+  parser.add_argument(
+      "--embedding_store_rows",
+      type=int,
+      default=topic_clustering.EMBEDDING_STORE_ROWS,
+      help=(
+          "the maximum number of review and topic embeddings kept on disk, so"
+          " that they are not computed again by later batches and runs, or 0"
+          " to disable the store (defaults to"
+          f" {topic_clustering.EMBEDDING_STORE_ROWS})"
+      ),
+  )
   parser.add_argument(
       "-q",
       "--quiet",
@@ -216,6 +623,36 @@ def main(argv):
   flags[REVIEWS] = not args.no_reviews
   flags[SENTIMENT] = not args.no_sentiment
   flags[TOPIC_CLUSTERING] = not args.no_topic_clustering
+  flags[WORKERS] = max(args.workers, 1)
+  flags[BATCH_REQUESTS] = not args.no_batch_requests
+  flags[SETTLE_DAYS] = max(args.settle_days, 0)
+  flags[INCREMENTAL_REVIEWS] = args.incremental_reviews
+  flags[FULL_RESYNC] = args.full_resync
+  flags[RESUME] = args.resume
+  flags[WRITERS] = max(args.bq_writers, 0)
+  flags[WRITE_QUEUE_SIZE] = max(args.write_queue_size, 1)
+  flags[BQ_SINK] = args.bq_sink
+  flags[BQ_INFLIGHT] = max(args.bq_inflight, 1)
+  flags[BQ_BUFFER_ROWS] = max(args.bq_buffer_rows, 0)
+  flags[BQ_BUFFER_SECONDS] = max(args.bq_buffer_seconds, 0)
+  flags[SINK] = args.sink
+  if args.sink_path:
+    flags[SINK_PATH] = args.sink_path
+  flags[READ_STREAMS] = max(args.read_streams, 0)
+  flags[NLP_WORKERS] = max(args.nlp_workers, 1)
+  flags[NLP_RPM] = max(args.nlp_rpm, 0)
+  flags[NLP_CACHE_MB] = max(args.nlp_cache_mb, 0)
+  flags[NLP_FEATURES] = args.nlp_features
+  flags[COMPACT_SENTIMENTS] = args.compact_sentiments
+  flags[REVIEW_TEXT] = args.review_text
+  if args.model_cache_dir:
+    flags[MODEL_CACHE_DIR] = args.model_cache_dir
+  flags[MIN_CLUSTERS] = max(args.min_clusters, 2)
+  flags[MAX_CLUSTERS] = max(args.max_clusters, flags[MIN_CLUSTERS])
+  flags[CLUSTERS_PATIENCE] = max(args.clusters_patience, 0)
+  flags[CLUSTER_SCORE] = args.cluster_score
+  flags[CLUSTER_SCORE_THRESHOLD] = max(args.cluster_score_threshold, 2)
+  flags[EMBEDDING_STORE_ROWS] = max(args.embedding_store_rows, 0)
 
   sentiment_only = args.sentiment_only
   quiet = args.quiet
@@ -246,7 +683,8 @@ def main(argv):
   if sentiment_only:
     if flags[SENTIMENT]:
       logging.info("Running sentiment analysis for all reviews in BigQuery...")
-      Alligator.sentiment_only(project_id, language, flags)
+      if Alligator.sentiment_only(project_id, language, flags):
+        sys.exit(1)
     else:
       logging.warning(
           "No action will be performed as --no_sentiment and --sentiment_only"
@@ -257,13 +695,17 @@ def main(argv):
   logging.info("Loading Google My Business reviews into BigQuery...")
 
   if account_id and location_id:
-    Alligator.for_account_and_location(
+    failures = Alligator.for_account_and_location(
         project_id, account_id, location_id, language, flags
     )
   elif account_id:
-    Alligator.for_account(project_id, account_id, language, flags)
+    failures = Alligator.for_account(project_id, account_id, language, flags)
   else:
-    Alligator.all(project_id, language, flags)
+    failures = Alligator.all(project_id, language, flags)
+
+  # Callers such as cron jobs need to know that the run has to be resumed.
+  if failures:
+    sys.exit(1)
 
   logging.info("Done.")
 
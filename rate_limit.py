@@ -0,0 +1,53 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+
+
+class TokenBucket(object):
+  """Limits the rate of the requests sent from one or more threads.
+
+  The bucket holds up to one second worth of requests, so short bursts are
+  allowed while the average rate stays within the limit.
+  """
+
+  def __init__(self, rate):
+    """Creates a token bucket.
+
+    Args:
+      rate: the maximum number of requests per second, or 0 for no limit.
+    """
+    self.rate = rate
+    self.capacity = max(rate, 1)
+    self.tokens = self.capacity
+    self.updated = time.monotonic()
+    self.lock = threading.Lock()
+
+  def acquire(self):
+    """Waits until a request can be sent without exceeding the rate."""
+    if not self.rate:
+      return
+
+    with self.lock:
+      while True:
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated) * self.rate
+        )
+        self.updated = now
+        if self.tokens >= 1:
+          self.tokens = self.tokens - 1
+          return
+        time.sleep((1 - self.tokens) / self.rate)
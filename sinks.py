@@ -0,0 +1,660 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import concurrent.futures
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaFileUpload
+
+try:
+  import pyarrow as pa
+  import pyarrow.parquet as pq
+except ImportError:
+  pa = None
+
+try:
+  import duckdb
+except ImportError:
+  duckdb = None
+
+# BigQuery allows up to 10 MB per insertAll request, and recommends at most 500
+# rows. Some headroom is left for the rest of the request body.
+BQ_TABLEDATA_INSERTALL_MAX_ROWS = 500
+BQ_TABLEDATA_INSERTALL_MAX_BYTES = 9 * 1024 * 1024
+BQ_JOBS_POLL_SECONDS = 5
+
+
+def is_payload_too_large(err):
+  """Returns whether an HttpError was caused by a too large request body."""
+  status = getattr(err.resp, "status", None)
+  return status == 413 or (
+      status == 400 and "payload size" in str(err).lower()
+  )
+
+
+class Sink(object):
+  """Destination of the rows retrieved by the API.
+
+  Attributes:
+    deferred: whether written rows are only stored once the sink is flushed.
+  """
+
+  deferred = False
+
+  def write(self, table_name, data):
+    """Writes rows into a table.
+
+    Args:
+      table_name: the name of the table, as defined in schemas.json.
+      data: the rows to write.
+    """
+    raise NotImplementedError
+
+  def flush(self):
+    """Stores the rows written so far, for deferred sinks.
+
+    Returns:
+      A dict with the tables which had rows stored as keys, and None or the
+      exception raised while storing them as values.
+    """
+    return {}
+
+  def close(self):
+    """Releases the resources held by the sink."""
+
+
+class InsertError(Exception):
+  """Raised when BigQuery rejects the rows of an insertAll request."""
+
+
+class BigQuerySink(Sink):
+  """Streams rows into BigQuery with tabledata.insertAll."""
+
+  def __init__(
+      self, bq_service, project_id, dataset_id, schemas, num_retries, inflight=1
+  ):
+    self.bq_service = bq_service
+    self.project_id = project_id
+    self.dataset_id = dataset_id
+    self.schemas = schemas
+    self.num_retries = num_retries
+    self.inflight = inflight
+    self.lock = threading.RLock()
+    self.dataset_exists = False
+    self.existing_tables = {}
+    self.insert_stats = {}
+
+  def ensure_dataset_exists(self):
+    with self.lock:
+      self._ensure_dataset_exists()
+
+  def _ensure_dataset_exists(self):
+    if self.dataset_exists:
+      return
+
+    try:
+      self.bq_service.datasets().get(
+          projectId=self.project_id, datasetId=self.dataset_id
+      ).execute(num_retries=self.num_retries)
+
+      logging.info(
+          f"Dataset {self.project_id}:{self.dataset_id} already exists."
+      )
+
+      self.dataset_exists = True
+
+      return
+    except HttpError as err:
+      if err.resp.status != 404:
+        raise
+
+    dataset = {
+        "datasetReference": {
+            "projectId": self.project_id,
+            "datasetId": self.dataset_id,
+        }
+    }
+
+    self.bq_service.datasets().insert(
+        projectId=self.project_id, body=dataset
+    ).execute(num_retries=self.num_retries)
+
+    self.dataset_exists = True
+
+  def ensure_table_exists(self, table_name):
+    with self.lock:
+      self._ensure_table_exists(table_name)
+
+  def _ensure_table_exists(self, table_name):
+    if self.existing_tables.get(table_name):
+      return
+
+    try:
+      existing_table = self.bq_service.tables().get(
+          projectId=self.project_id,
+          datasetId=self.dataset_id,
+          tableId=table_name,
+      ).execute(num_retries=self.num_retries)
+
+      logging.info(
+          f"Table {self.project_id}:{self.dataset_id}.{table_name} already"
+          " exists."
+      )
+
+      self.add_missing_fields(table_name, existing_table)
+      self.existing_tables[table_name] = True
+
+      return
+    except HttpError as err:
+      if err.resp.status != 404:
+        raise
+
+    table = {
+        "schema": {"fields": self.schemas.get(table_name)},
+        "tableReference": {
+            "projectId": self.project_id,
+            "datasetId": self.dataset_id,
+            "tableId": table_name,
+        },
+        "timePartitioning": {"type": "DAY"},
+    }
+
+    self.bq_service.tables().insert(
+        projectId=self.project_id, datasetId=self.dataset_id, body=table
+    ).execute(num_retries=self.num_retries)
+
+    self.existing_tables[table_name] = True
+
+  def add_missing_fields(self, table_name, existing_table):
+    """Adds the fields of the schema which a table created earlier lacks.
+
+    Rows are written with ignoreUnknownValues, so the values of fields added to
+    the schema by newer versions would otherwise be dropped silently.
+
+    Args:
+      table_name: the name of the table.
+      existing_table: the table resource returned by tables.get.
+    """
+    fields = existing_table.get("schema", {}).get("fields", [])
+    names = {field.get("name") for field in fields}
+    missing = [
+        field
+        for field in self.schemas.get(table_name) or []
+        if field.get("name") not in names
+    ]
+    if not missing:
+      return
+
+    self.bq_service.tables().patch(
+        projectId=self.project_id,
+        datasetId=self.dataset_id,
+        tableId=table_name,
+        body={"schema": {"fields": fields + missing}},
+    ).execute(num_retries=self.num_retries)
+
+    logging.info(
+        f"Added the fields {', '.join(f.get('name') for f in missing)} to"
+        f" table {self.project_id}:{self.dataset_id}.{table_name}."
+    )
+
+  def write(self, table_name, data):
+    self.ensure_dataset_exists()
+    self.ensure_table_exists(table_name)
+
+    rows = [{"json": line, "insertId": line.get("name")} for line in data]
+    chunks = self.chunk_rows(rows)
+    inflight = min(self.inflight, len(chunks))
+
+    if inflight > 1:
+      with concurrent.futures.ThreadPoolExecutor(max_workers=inflight) as pool:
+        futures = [
+            pool.submit(self.insert_chunk, table_name, chunk)
+            for chunk in chunks
+        ]
+        concurrent.futures.wait(futures)
+    else:
+      futures = []
+      for chunk in chunks:
+        future = concurrent.futures.Future()
+        future.set_result(self.insert_chunk(table_name, chunk))
+        futures.append(future)
+
+    failed_chunks = 0
+    rejected_chunks = 0
+    first_exception = None
+    for i, future in enumerate(futures):
+      if future.exception():
+        failed_chunks = failed_chunks + 1
+        first_exception = first_exception or future.exception()
+        logging.error(
+            f"Chunk {i + 1} of {len(chunks)} for table {table_name} failed:"
+            f" {str(future.exception())}"
+        )
+      elif future.result():
+        failed_chunks = failed_chunks + 1
+        rejected_chunks = rejected_chunks + 1
+        logging.error(
+            f"Errors found in chunk {i + 1} of {len(chunks)} of the BigQuery"
+            f" insert operation into table {table_name}. Details below."
+        )
+        logging.error(future.result())
+
+    if failed_chunks and len(chunks) > 1:
+      logging.error(
+          f"{failed_chunks} of {len(chunks)} chunks inserted into table"
+          f" {table_name} had errors."
+      )
+
+    if first_exception:
+      raise first_exception
+    # Without skipInvalidRows, a chunk with errors was not inserted at all, so
+    # the write must fail for its watermarks not to advance.
+    if rejected_chunks:
+      raise InsertError(
+          f"BigQuery rejected {rejected_chunks} of {len(chunks)} chunks"
+          f" inserted into table {table_name}."
+      )
+
+  def chunk_rows(self, rows):
+    """Splits rows into insertAll requests within BigQuery's limits.
+
+    Chunks are sized by serialized bytes as well as by row count, so that
+    small rows (e.g. reviews) are sent in few requests, while large rows (e.g.
+    insights holding months of daily metrics) stay under the request size
+    limit.
+
+    Args:
+      rows: the rows to insert, in the insertAll format.
+
+    Returns:
+      A list of chunks of rows.
+    """
+    chunks = []
+    chunk = []
+    chunk_bytes = 0
+
+    for row in rows:
+      # Add a couple of bytes for the separator between rows.
+      row_bytes = len(json.dumps(row).encode("utf-8")) + 2
+      if chunk and (
+          len(chunk) >= BQ_TABLEDATA_INSERTALL_MAX_ROWS
+          or chunk_bytes + row_bytes > BQ_TABLEDATA_INSERTALL_MAX_BYTES
+      ):
+        chunks.append(chunk)
+        chunk = []
+        chunk_bytes = 0
+
+      chunk.append(row)
+      chunk_bytes = chunk_bytes + row_bytes
+
+    if chunk:
+      chunks.append(chunk)
+
+    return chunks
+
+  def insert_chunk(self, table_name, chunk):
+    """Inserts a chunk of rows, splitting it if the request is too large.
+
+    Args:
+      table_name: the table to insert the rows into.
+      chunk: the rows to insert, in the insertAll format.
+
+    Returns:
+      The insertErrors reported by BigQuery, if any.
+    """
+    logging.info(
+        f"Inserting {len(chunk)} rows into table"
+        f" {self.project_id}:{self.dataset_id}.{table_name}."
+    )
+
+    data_chunk = {"rows": chunk, "ignoreUnknownValues": True}
+
+    try:
+      result = (
+          self.bq_service.tabledata()
+          .insertAll(
+              projectId=self.project_id,
+              datasetId=self.dataset_id,
+              tableId=table_name,
+              body=data_chunk,
+          )
+          .execute(num_retries=self.num_retries)
+      )
+    except HttpError as err:
+      if not is_payload_too_large(err) or len(chunk) < 2:
+        raise
+
+      # The estimate was off (e.g. due to escaping), so retry in two halves.
+      logging.warning(
+          f"Request of {len(chunk)} rows into table {table_name} is too"
+          " large, splitting it in two."
+      )
+      self.record_insert(table_name, splits=1)
+      half = len(chunk) // 2
+      insert_errors = self.insert_chunk(table_name, chunk[:half])
+      for insert_error in self.insert_chunk(table_name, chunk[half:]):
+        # Keep the row indexes relative to the whole chunk.
+        insert_errors.append(
+            dict(insert_error, index=insert_error.get("index", 0) + half)
+        )
+      return insert_errors
+
+    self.record_insert(
+        table_name,
+        requests=1,
+        rows=len(chunk),
+        num_bytes=len(json.dumps(data_chunk).encode("utf-8")),
+    )
+
+    return result.get("insertErrors") or []
+
+  def record_insert(
+      self, table_name, requests=0, rows=0, num_bytes=0, splits=0
+  ):
+    with self.lock:
+      stats = self.insert_stats.setdefault(
+          table_name,
+          {"requests": 0, "rows": 0, "bytes": 0, "max_bytes": 0, "splits": 0},
+      )
+      stats["requests"] = stats["requests"] + requests
+      stats["rows"] = stats["rows"] + rows
+      stats["bytes"] = stats["bytes"] + num_bytes
+      stats["max_bytes"] = max(stats["max_bytes"], num_bytes)
+      stats["splits"] = stats["splits"] + splits
+
+  def close(self):
+    for table_name, stats in sorted(self.insert_stats.items()):
+      if not stats["requests"]:
+        continue
+      logging.info(
+          f"Table {table_name}: {stats['rows']} rows inserted in"
+          f" {stats['requests']} requests (averaging"
+          f" {stats['rows'] // stats['requests']} rows and"
+          f" {stats['bytes'] // stats['requests']} bytes, largest"
+          f" {stats['max_bytes']} bytes, {stats['splits']} splits)."
+      )
+
+
+class BigQueryLoadJobSink(BigQuerySink):
+  """Stages rows locally and loads them with one BigQuery load job per table."""
+
+  deferred = True
+
+  def __init__(self, *args, **kwargs):
+    super().__init__(*args, **kwargs)
+    self.staging_lock = threading.Lock()
+    self.staging_dir = None
+    self.staged_tables = set()
+    self.failed_files = []
+
+  def write(self, table_name, data):
+    """Appends rows to the newline-delimited JSON file staged for a table.
+
+    Args:
+      table_name: the table the rows are meant for.
+      data: the rows to stage.
+    """
+    with self.staging_lock:
+      if not self.staging_dir:
+        self.staging_dir = tempfile.mkdtemp(prefix="alligator_")
+
+      path = os.path.join(self.staging_dir, f"{table_name}.json")
+      with open(path, "a") as staging_file:
+        for line in data:
+          staging_file.write(json.dumps(line) + "\n")
+
+      self.staged_tables.add(table_name)
+
+  def flush(self):
+    """Loads the rows staged for each table with a single load job."""
+    # Staged files are moved aside first, so that rows staged in the meantime
+    # go into a new file.
+    with self.staging_lock:
+      staged_tables = self.staged_tables
+      self.staged_tables = set()
+      for table_name in staged_tables:
+        staged_path = os.path.join(self.staging_dir, f"{table_name}.json")
+        os.replace(staged_path, f"{staged_path}.loading")
+
+    results = {}
+    for table_name in sorted(staged_tables):
+      path = os.path.join(self.staging_dir, f"{table_name}.json.loading")
+      try:
+        self.load_file(table_name, path)
+      except Exception as err:  # pylint: disable=broad-except
+        # The file holds the only copy of the rows, so it is kept under a name
+        # the next flush does not reuse.
+        failed_path = os.path.join(
+            self.staging_dir,
+            f"{table_name}.{len(self.failed_files)}.json.failed",
+        )
+        os.replace(path, failed_path)
+        self.failed_files.append(failed_path)
+        logging.error(
+            f"Failed to load {failed_path} into table"
+            f" {self.project_id}:{self.dataset_id}.{table_name}: {str(err)}"
+        )
+        results[table_name] = err
+      else:
+        os.remove(path)
+        results[table_name] = None
+
+    return results
+
+  def close(self):
+    """Deletes the staging directory, unless it holds rows which failed."""
+    super().close()
+    if not self.staging_dir:
+      return
+
+    if self.failed_files:
+      logging.warning(
+          f"Keeping the rows which failed to load in {self.staging_dir}."
+      )
+    else:
+      shutil.rmtree(self.staging_dir, ignore_errors=True)
+      self.staging_dir = None
+
+  def load_file(self, table_name, path):
+    self.ensure_dataset_exists()
+    self.ensure_table_exists(table_name)
+
+    logging.info(
+        f"Loading {os.path.getsize(path)} bytes into table"
+        f" {self.project_id}:{self.dataset_id}.{table_name}."
+    )
+
+    job = {
+        "configuration": {
+            "load": {
+                "destinationTable": {
+                    "projectId": self.project_id,
+                    "datasetId": self.dataset_id,
+                    "tableId": table_name,
+                },
+                "schema": {"fields": self.schemas.get(table_name)},
+                "timePartitioning": {"type": "DAY"},
+                "sourceFormat": "NEWLINE_DELIMITED_JSON",
+                "writeDisposition": "WRITE_APPEND",
+                "ignoreUnknownValues": True,
+            }
+        }
+    }
+
+    media = MediaFileUpload(
+        path, mimetype="application/octet-stream", resumable=True
+    )
+    response_json = (
+        self.bq_service.jobs()
+        .insert(projectId=self.project_id, body=job, media_body=media)
+        .execute(num_retries=self.num_retries)
+    )
+    job_reference = response_json.get("jobReference")
+
+    while response_json.get("status", {}).get("state") != "DONE":
+      time.sleep(BQ_JOBS_POLL_SECONDS)
+      response_json = (
+          self.bq_service.jobs()
+          .get(
+              projectId=self.project_id,
+              jobId=job_reference.get("jobId"),
+              location=job_reference.get("location"),
+          )
+          .execute(num_retries=self.num_retries)
+      )
+
+    status = response_json.get("status")
+    if "errorResult" in status:
+      logging.error(status.get("errors"))
+      raise RuntimeError(status.get("errorResult").get("message"))
+
+
+def arrow_type(field):
+  """Returns the Arrow type of a field defined in schemas.json."""
+  field_type = field.get("type")
+  if field_type in ("RECORD", "STRUCT"):
+    value_type = pa.struct(
+        [pa.field(f["name"], arrow_type(f)) for f in field.get("fields")]
+    )
+  elif field_type in ("INT64", "INTEGER"):
+    value_type = pa.int64()
+  elif field_type in ("FLOAT64", "FLOAT"):
+    value_type = pa.float64()
+  elif field_type in ("BOOL", "BOOLEAN"):
+    value_type = pa.bool_()
+  else:
+    # Timestamps are kept as the RFC 3339 strings returned by the APIs.
+    value_type = pa.string()
+
+  if field.get("mode") == "REPEATED":
+    return pa.list_(value_type)
+  return value_type
+
+
+def coerce_value(value, field):
+  """Converts an API value to the type of a field defined in schemas.json.
+
+  The APIs return e.g. 64-bit integers as strings. Like BigQuery with
+  ignoreUnknownValues, values which are not in the schema are dropped.
+
+  Args:
+    value: the value returned by the API.
+    field: the schema field of the value.
+
+  Returns:
+    The converted value.
+  """
+  if value is None:
+    return None
+
+  if field.get("mode") == "REPEATED":
+    if not isinstance(value, list):
+      value = [value]
+    return [coerce_value(v, dict(field, mode="NULLABLE")) for v in value]
+
+  field_type = field.get("type")
+  if field_type in ("RECORD", "STRUCT"):
+    if not isinstance(value, dict):
+      return None
+    return {
+        f["name"]: coerce_value(value.get(f["name"]), f)
+        for f in field.get("fields")
+    }
+  if field_type in ("INT64", "INTEGER"):
+    return int(value)
+  if field_type in ("FLOAT64", "FLOAT"):
+    return float(value)
+  if field_type in ("BOOL", "BOOLEAN"):
+    return value if isinstance(value, bool) else str(value).lower() == "true"
+  if isinstance(value, (dict, list)):
+    return json.dumps(value)
+  return str(value)
+
+
+class ParquetSink(Sink):
+  """Writes rows into local Parquet files, one directory per table."""
+
+  def __init__(self, path, schemas):
+    if not pa:
+      raise ImportError("The parquet sink requires: pip install pyarrow")
+
+    self.path = path
+    self.schemas = schemas
+    self.lock = threading.Lock()
+    self.part_numbers = {}
+
+  def to_arrow(self, table_name, data):
+    fields = self.schemas.get(table_name)
+    schema = pa.schema([pa.field(f["name"], arrow_type(f)) for f in fields])
+    rows = [
+        {f["name"]: coerce_value(line.get(f["name"]), f) for f in fields}
+        for line in data
+    ]
+    return pa.Table.from_pylist(rows, schema=schema)
+
+  def write(self, table_name, data):
+    table = self.to_arrow(table_name, data)
+
+    with self.lock:
+      part_number = self.part_numbers.get(table_name, 0)
+      self.part_numbers[table_name] = part_number + 1
+
+    table_path = os.path.join(self.path, table_name)
+    os.makedirs(table_path, exist_ok=True)
+    file_name = f"{time.strftime('%Y%m%d%H%M%S')}-{part_number:06d}.parquet"
+    pq.write_table(table, os.path.join(table_path, file_name))
+
+    logging.info(
+        f"Wrote {len(data)} rows into {os.path.join(table_path, file_name)}."
+    )
+
+
+class DuckDBSink(ParquetSink):
+  """Writes rows into the tables of a local DuckDB database."""
+
+  def __init__(self, path, schemas):
+    if not duckdb:
+      raise ImportError("The duckdb sink requires: pip install duckdb pyarrow")
+
+    super().__init__(path, schemas)
+    self.connection = duckdb.connect(path)
+    self.existing_tables = set()
+
+  def write(self, table_name, data):
+    batch = self.to_arrow(table_name, data)
+
+    # DuckDB connections must not be shared between threads without a lock.
+    with self.lock:
+      self.connection.register("batch", batch)
+      if table_name not in self.existing_tables:
+        self.connection.execute(
+            f"CREATE TABLE IF NOT EXISTS {table_name} AS"
+            " SELECT * FROM batch LIMIT 0"
+        )
+        self.existing_tables.add(table_name)
+      self.connection.execute(f"INSERT INTO {table_name} SELECT * FROM batch")
+      self.connection.unregister("batch")
+
+    logging.info(f"Inserted {len(data)} rows into {self.path}:{table_name}.")
+
+  def close(self):
+    with self.lock:
+      self.connection.close()
@@ -27,9 +27,11 @@ SELECT
   s.topic AS topic # remove if not using the topic_clustering feature
 FROM
   `<PROJECT_ID>.alligator.sentiments` AS s
-  CROSS JOIN
+  # LEFT JOINs keep the annotations requested without entities or sentences
+  # (see --nlp_features), with the corresponding columns left NULL.
+  LEFT JOIN
     UNNEST(s.annotation.entities) AS entities
-  CROSS JOIN
+  LEFT JOIN
     UNNEST(s.annotation.sentences) AS sentences
   JOIN `<PROJECT_ID>.alligator.reviews` AS r
     ON s.name = r.name
@@ -0,0 +1,131 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import sqlite3
+import threading
+
+
+class StateStore(object):
+  """Persists the incremental loading state between runs in SQLite."""
+
+  def __init__(self, path):
+    self.lock = threading.Lock()
+    self.connection = sqlite3.connect(path, check_same_thread=False)
+
+    with self.lock, self.connection:
+      self.connection.execute("""
+          CREATE TABLE IF NOT EXISTS watermarks (
+            report TEXT NOT NULL,
+            location_name TEXT NOT NULL,
+            value TEXT NOT NULL,
+            PRIMARY KEY (report, location_name)
+          )""")
+      self.connection.execute("""
+          CREATE TABLE IF NOT EXISTS journal (
+            report TEXT NOT NULL,
+            location_name TEXT NOT NULL,
+            PRIMARY KEY (report, location_name)
+          )""")
+
+  def get_watermark(self, report, location_name):
+    """Returns the last value successfully loaded for a location and report.
+
+    Args:
+      report: the report type, e.g. "insights".
+      location_name: the legacy location name.
+
+    Returns:
+      The stored watermark as a string, or None if there is none yet.
+    """
+    with self.lock:
+      row = self.connection.execute(
+          "SELECT value FROM watermarks WHERE report = ? AND location_name = ?",
+          (report, location_name),
+      ).fetchone()
+
+    return row[0] if row else None
+
+  def set_watermark(self, report, location_names, value):
+    """Stores the last value successfully loaded for one or more locations.
+
+    Args:
+      report: the report type, e.g. "insights".
+      location_names: a legacy location name or a list of them.
+      value: the watermark to store, as a string.
+    """
+    if isinstance(location_names, str):
+      location_names = [location_names]
+
+    with self.lock, self.connection:
+      self.connection.executemany(
+          "INSERT OR REPLACE INTO watermarks (report, location_name, value)"
+          " VALUES (?, ?, ?)",
+          [(report, location_name, value) for location_name in location_names],
+      )
+
+  def start_run(self, resume=False):
+    """Starts a new run journal, unless an interrupted run is being resumed.
+
+    Args:
+      resume: whether to keep the units completed by the previous run.
+    """
+    with self.lock, self.connection:
+      if resume:
+        count = self.connection.execute(
+            "SELECT COUNT(*) FROM journal"
+        ).fetchone()[0]
+        logging.info(f"Resuming run with {count} units already completed.")
+      else:
+        self.connection.execute("DELETE FROM journal")
+
+  def is_done(self, report, location_name):
+    """Returns whether a unit was completed during the current run.
+
+    Args:
+      report: the report type, e.g. "insights".
+      location_name: the legacy location name.
+
+    Returns:
+      True if the report was already loaded for the location.
+    """
+    with self.lock:
+      row = self.connection.execute(
+          "SELECT 1 FROM journal WHERE report = ? AND location_name = ?",
+          (report, location_name),
+      ).fetchone()
+
+    return row is not None
+
+  def mark_done(self, report, location_names):
+    """Records the units completed during the current run.
+
+    Args:
+      report: the report type, e.g. "insights".
+      location_names: a legacy location name or a list of them.
+    """
+    if isinstance(location_names, str):
+      location_names = [location_names]
+
+    with self.lock, self.connection:
+      self.connection.executemany(
+          "INSERT OR REPLACE INTO journal (report, location_name)"
+          " VALUES (?, ?)",
+          [(report, location_name) for location_name in location_names],
+      )
+
+  def finish_run(self):
+    """Clears the run journal once every unit has been completed."""
+    with self.lock, self.connection:
+      self.connection.execute("DELETE FROM journal")
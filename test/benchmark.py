@@ -0,0 +1,362 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmarks for Alligator's request paths, using the data filler."""
+
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from api import API
+from rate_limit import TokenBucket
+from sinks import DuckDBSink
+from sinks import ParquetSink
+from sinks import Sink
+from state import StateStore
+from test import data_filler
+from test.data_filler import DataFiller
+import topic_clustering
+from topic_clustering import TopicClustering
+
+ACCOUNT_NAME = "accounts/1234567890"
+
+
+def offline_api(flags, sink=None):
+  """Builds an API object backed by the data filler, without authentication.
+
+  Args:
+      flags: the flags to run the API with.
+      sink: the Sink to write the rows into. Rows are discarded if None.
+  Returns:
+      An API object which does not call any Google API.
+  """
+  api = API.__new__(API)
+  api.flags = flags
+  api.language = None
+  api.gmb_service = DataFiller()
+  api.nlp_service = FakeLanguageService()
+  api.nlp_limiter = TokenBucket(flags.get("nlp_rpm", 0) / 60)
+  api.annotation_cache = None
+  api.topic_clustering = None
+  api.state = StateStore(":memory:")
+  api.setup_writes(sink or DiscardSink())
+  return api
+
+
+class DiscardSink(Sink):
+  """Discards all the rows written into it."""
+
+  def write(self, table_name, data):
+    pass
+
+
+class FakeLanguageService(object):
+  """Annotates documents with a neutral sentiment, after a simulated delay."""
+
+  def documents(self):
+    return self
+
+  def annotateText(self, body):  # pylint: disable=invalid-name
+    return self.annotation(body)
+
+  class annotation(object):  # pylint: disable=invalid-name
+
+    def __init__(self, body):
+      self.body = body
+
+    def execute(self, num_retries=None):
+      time.sleep(data_filler.SIMULATED_LATENCY_SECONDS)
+      return {
+          "documentSentiment": {"magnitude": 0.0, "score": 0.0},
+          "language": "en",
+      }
+
+
+def benchmark_hourly_calls(args):
+  """Compares the serial and batched hourly calls request paths.
+
+  Args:
+      args: the parsed command line arguments.
+  Returns:
+      Nothing.
+  """
+  data_filler.SIMULATED_LATENCY_SECONDS = args.latency
+  location_names = [
+      f"{ACCOUNT_NAME}/locations/{i}" for i in range(args.locations)
+  ]
+
+  for batch_requests in [False, True]:
+    api = offline_api({"batch_requests": batch_requests})
+    start = time.perf_counter()
+    rows = api.hourly_calls(location_names)
+    elapsed = time.perf_counter() - start
+    logging.info(
+        f"hourly_calls [batch_requests={batch_requests}]: {len(rows)} rows"
+        f" in {elapsed:.2f}s"
+    )
+
+
+def benchmark_pipeline(args):
+  """Measures the throughput of the whole pipeline into a local sink.
+
+  Args:
+      args: the parsed command line arguments.
+  Returns:
+      Nothing.
+  """
+  data_filler.SIMULATED_LATENCY_SECONDS = args.latency
+  location_names = [
+      f"{ACCOUNT_NAME}/locations/{i}" for i in range(args.locations)
+  ]
+
+  with open("schemas.json") as schemas_file:
+    schemas = json.load(schemas_file)
+
+  with tempfile.TemporaryDirectory() as output_dir:
+    sinks = {
+        "discard": DiscardSink,
+        "parquet": lambda: ParquetSink(output_dir, schemas),
+        "duckdb": lambda: DuckDBSink(
+            os.path.join(output_dir, "alligator.duckdb"), schemas
+        ),
+    }
+    api = offline_api(
+        {"writers": args.writers, "write_queue_size": 100},
+        sinks[args.sink](),
+    )
+
+    start = time.perf_counter()
+    num_rows = len(api.insights(location_names))
+    num_rows = num_rows + len(api.directions(location_names))
+    num_rows = num_rows + len(api.hourly_calls(location_names))
+    for location_name in location_names:
+      api.reviews(location_name)
+    api.close()
+    elapsed = time.perf_counter() - start
+
+  logging.info(
+      f"pipeline [sink={args.sink}, writers={args.writers}]: {num_rows}"
+      f" insights, directions and hourly calls rows plus reviews for"
+      f" {args.locations} locations in {elapsed:.2f}s"
+  )
+
+
+def benchmark_sentiments(args):
+  """Compares serial and concurrent annotation of reviews.
+
+  Args:
+      args: the parsed command line arguments.
+  Returns:
+      Nothing.
+  """
+  data_filler.SIMULATED_LATENCY_SECONDS = args.latency
+  rows = [
+      {
+          "comment": f"Review number {i} of a location.",
+          "name": f"{ACCOUNT_NAME}/locations/{i % args.locations}",
+          "reviewId": str(i),
+      }
+      for i in range(args.reviews)
+  ]
+
+  for nlp_workers in sorted({1, args.nlp_workers}):
+    api = offline_api({"nlp_workers": nlp_workers, "nlp_rpm": args.nlp_rpm})
+    start = time.perf_counter()
+    api.process_sentiments(rows)
+    api.close()
+    elapsed = time.perf_counter() - start
+    logging.info(
+        f"sentiments [nlp_workers={nlp_workers}, nlp_rpm={args.nlp_rpm}]:"
+        f" {len(rows)} reviews in {elapsed:.2f}s"
+        f" ({len(rows) / elapsed:.1f} reviews/s)"
+    )
+
+
+def benchmark_startup(args):
+  """Measures the time Alligator takes to start, in fresh interpreters.
+
+  Args:
+      args: the parsed command line arguments.
+  Returns:
+      Nothing.
+  """
+  statements = {
+      "import": "import main",
+      "topic clustering": (
+          "import topic_clustering;"
+          " topic_clustering.TopicClustering(embedding_store_rows=0)"
+      ),
+  }
+  if args.load_model:
+    statements["model load"] = (
+        "import topic_clustering; topic_clustering.TopicClustering("
+        "embedding_store_rows=0).model"
+    )
+
+  for name, statement in statements.items():
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", statement], check=True)
+    elapsed = time.perf_counter() - start
+    logging.info(f"startup [{name}]: {elapsed:.2f}s")
+
+
+def estimator_clusters(vectors, num_clusters, max_iterations=10, seed=32):
+  """Clusters vectors with the TensorFlow KMeans estimator used previously.
+
+  Args:
+      vectors: matrix containing the embeddings to cluster.
+      num_clusters: the number of clusters to use.
+      max_iterations: the maximum number of iterations for k-means to perform.
+      seed: seed
+  Returns:
+      The cluster index of each vector.
+  """
+  tf = topic_clustering.tf
+  kmeans = tf.compat.v1.estimator.experimental.KMeans(
+      num_clusters=num_clusters,
+      use_mini_batch=False,
+      seed=seed,
+      distance_metric=tf.compat.v1.estimator.experimental.KMeans.COSINE_DISTANCE,
+  )
+
+  def input_fn():
+    return tf.compat.v1.train.limit_epochs(
+        tf.convert_to_tensor(vectors, dtype=tf.float32), num_epochs=1
+    )
+
+  score = 0
+  for _ in range(max_iterations):
+    kmeans.train(input_fn)
+    new_score = kmeans.score(input_fn)
+    if np.divide(score, new_score) > 1.1 or score == 0:
+      score = new_score
+    else:
+      break
+
+  return list(kmeans.predict_cluster_index(input_fn))
+
+
+def benchmark_kmeans(args):
+  """Compares the NumPy k-means with the TensorFlow KMeans estimator.
+
+  Args:
+      args: the parsed command line arguments.
+  Returns:
+      Nothing.
+  """
+  vectors = np.random.default_rng(0).normal(size=(args.reviews, 512))
+  vectors = vectors.astype(np.float32)
+  clustering = TopicClustering(embedding_store_rows=0)
+
+  engines = {"numpy": lambda k: clustering.generate_clusters(vectors, k)}
+  try:
+    topic_clustering.import_tensorflow()
+    engines["estimator"] = lambda k: estimator_clusters(vectors, k)
+  except ImportError:
+    logging.warning("TensorFlow is not installed, skipping the estimator.")
+
+  for name, engine in engines.items():
+    for num_clusters in [5, 10]:
+      start = time.perf_counter()
+      engine(num_clusters)
+      elapsed = time.perf_counter() - start
+      logging.info(
+          f"kmeans [{name}, k={num_clusters}]: {args.reviews} vectors in"
+          f" {elapsed:.3f}s"
+      )
+
+
+BENCHMARKS = {
+    "hourly_calls": benchmark_hourly_calls,
+    "kmeans": benchmark_kmeans,
+    "pipeline": benchmark_pipeline,
+    "sentiments": benchmark_sentiments,
+    "startup": benchmark_startup,
+}
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument(
+      "benchmarks",
+      nargs="*",
+      default=list(BENCHMARKS),
+      help="the benchmarks to run (defaults to all of them)",
+  )
+  parser.add_argument(
+      "--locations",
+      type=int,
+      default=10,
+      help="the number of fake locations to use",
+  )
+  parser.add_argument(
+      "--latency",
+      type=float,
+      default=0.2,
+      help="the simulated round trip time of every request, in seconds",
+  )
+  parser.add_argument(
+      "--sink",
+      choices=["discard", "parquet", "duckdb"],
+      default="discard",
+      help="the local sink to write rows into in the pipeline benchmark",
+  )
+  parser.add_argument(
+      "--writers",
+      type=int,
+      default=0,
+      help="the number of writer threads in the pipeline benchmark",
+  )
+  parser.add_argument(
+      "--reviews",
+      type=int,
+      default=100,
+      help="the number of reviews in the sentiments and kmeans benchmarks",
+  )
+  parser.add_argument(
+      "--nlp_workers",
+      type=int,
+      default=10,
+      help="the number of concurrent annotations in the sentiments benchmark",
+  )
+  parser.add_argument(
+      "--nlp_rpm",
+      type=int,
+      default=0,
+      help="the Natural Language API rate limit in the sentiments benchmark",
+  )
+  parser.add_argument(
+      "--load_model",
+      action="store_true",
+      help="also measure loading the topic clustering model in the startup"
+      " benchmark (downloads the model on the first run)",
+  )
+  args = parser.parse_args()
+
+  logging.basicConfig(
+      format="[%(asctime)s] %(levelname)s %(message)s", level=logging.INFO
+  )
+  for name in args.benchmarks:
+    BENCHMARKS[name](args)
+
+
+if __name__ == "__main__":
+  main()
@@ -14,6 +14,7 @@
 # limitations under the License.
 
 from datetime import datetime, timedelta
+import time
 
 from faker import Faker
 from geopy.geocoders import GoogleV3
@@ -67,6 +68,10 @@ COUNTRIES = ["US"]
 LOCALE = ["en_US"]
 PRIMARY_CATEGORIES = [("gcid:supermarket", "Supermarket")]
 
+# Simulated round trip time of every request (and of every batch request), in
+# seconds. Set it to a realistic value to measure request-level optimizations.
+SIMULATED_LATENCY_SECONDS = 0
+
 USE_GOOGLE_MAPS = False
 GOOGLE_MAPS_API_KEY = ""
 
@@ -121,6 +126,44 @@ class DataFiller(object):
   def __init__(self):
     pass
 
+  def new_batch_http_request(self, callback=None):
+    return self.batch(callback=callback)
+
+  class batch(object):  # pylint: disable=invalid-name
+    """Simulates a batch request of the gmb service object.
+
+    All the requests added to the batch are answered after a single simulated
+    round trip.
+
+    Attributes:
+      callback: the function to call with every response.
+      requests: the list of (request_id, request, callback) to execute.
+    """
+
+    def __init__(self, callback=None):
+      self.callback = callback
+      self.requests = []
+
+    def add(self, request, callback=None, request_id=None):
+      if request_id is None:
+        request_id = str(len(self.requests))
+      self.requests.append((request_id, request, callback or self.callback))
+
+    def execute(self, http=None):
+      """Generates the responses for all the requests in the batch.
+
+      Args:
+          http: parameter ignored.
+      Returns:
+          Nothing.
+      """
+      del http
+      time.sleep(SIMULATED_LATENCY_SECONDS)
+      for request_id, request, callback in self.requests:
+        response = request.generate_report()
+        if callback:
+          callback(request_id, response, None)
+
   class accounts(object):  # pylint: disable=invalid-name
     """Simulates the accounts object in the gmb service object."""
 
@@ -402,7 +445,8 @@ class DataFiller(object):
             page_token: the page token to be decreased.
           """
 
-          def __init__(self, parent, pageToken=REVIEWS_PAGES):
+          def __init__(self, parent, pageToken=REVIEWS_PAGES, orderBy=None):
+            del orderBy
             self.account_id = parent
             if not pageToken:
               self.page_token = REVIEWS_PAGES
@@ -418,6 +462,7 @@ class DataFiller(object):
                 A list of fake reviews.
             """
             del num_retries
+            time.sleep(SIMULATED_LATENCY_SECONDS)
             data = []
             reviews_per_page = fake.random_int(min=1, max=REVIEWS_PER_PAGE)
             data = self.generate_reviews(reviews_per_page)
@@ -519,57 +564,72 @@ class DataFiller(object):
 
         Attributes:
           account_name: the full account name identifier.
-          location_name: the full location name identifier.
+          location_names: the full location name identifiers.
+          location_name: the location name currently being generated.
           body: the request body.
         """
 
         def __init__(self, name, body):
           self.account_name = name
           self.body = body
-          self.location_name = self.body["locationNames"][0]
+          self.location_names = self.body["locationNames"]
+          self.location_name = self.location_names[0]
 
         def execute(self, num_retries=None):
-          """Generates a list of fake locations.
+          """Generates fake insights for every requested location.
 
           Args:
               num_retries: parameter ignored.
           Returns:
-              A list of fake accounts.
+              A list of fake insights.
           """
           del num_retries
+          time.sleep(SIMULATED_LATENCY_SECONDS)
+          return self.generate_report()
+
+        def generate_report(self):
+          """Generates fake insights for every requested location.
+
+          Args:
+              None.
+          Returns:
+              A list of fake insights.
+          """
           data = []
 
           # Detect the type of insight to report
           metric_type = ""
-          if "basicRequest" in self.body:
-            metric_type = "locationMetrics"
-            # General insights or hourly calls
-            metric_requests = self.body["basicRequest"]["metricRequests"]
-            if (
-                "metric" in metric_requests
-                and metric_requests["metric"] == "ALL"
-            ):
-              # General insights
-              time_range = self.body["basicRequest"]["timeRange"]
-              start_time = time_range["startTime"]
-              end_time = time_range["endTime"]
-              item = self.generate_insights(start_time, end_time)
-              data.append(item)
-            else:
-              # This assumes ACTIONS_PHONE and BREAKDOWN_HOUR_OF_DAY.
-              time_range = self.body["basicRequest"]["timeRange"]
-              start_time = time_range["startTime"]
-              item = self.generate_hourly_calls(start_time)
+          for location_name in self.location_names:
+            self.location_name = location_name
+            if "basicRequest" in self.body:
+              metric_type = "locationMetrics"
+              # General insights or hourly calls
+              metric_requests = self.body["basicRequest"]["metricRequests"]
+              if (
+                  "metric" in metric_requests
+                  and metric_requests["metric"] == "ALL"
+              ):
+                # General insights
+                time_range = self.body["basicRequest"]["timeRange"]
+                start_time = time_range["startTime"]
+                end_time = time_range["endTime"]
+                item = self.generate_insights(start_time, end_time)
+                data.append(item)
+              else:
+                # This assumes ACTIONS_PHONE and BREAKDOWN_HOUR_OF_DAY.
+                time_range = self.body["basicRequest"]["timeRange"]
+                start_time = time_range["startTime"]
+                item = self.generate_hourly_calls(start_time)
+                data.append(item)
+            elif "drivingDirectionsRequest" in self.body:
+              metric_type = "locationDrivingDirectionMetrics"
+              # This assumes DIRECTIONS_NUM_DAYS
+              item = self.generate_directions()
               data.append(item)
-          elif "drivingDirectionsRequest" in self.body:
-            metric_type = "locationDrivingDirectionMetrics"
-            # This assumes DIRECTIONS_NUM_DAYS
-            item = self.generate_directions()
-            data.append(item)
 
           composed_data = {
               metric_type: data,
-              "location_name": self.location_name,
+              "location_name": self.location_names[0],
           }
 
           return composed_data
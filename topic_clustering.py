@@ -12,36 +12,86 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import concurrent.futures
 import logging
 import os
 
 import numpy as np
 import pandas as pd
-from sklearn.metrics import silhouette_score
-import tensorflow.compat.v2 as tf
-import tensorflow_hub as hub
-import tensorflow_text
+
+from embedding_store import EmbeddingStore
+
+# TensorFlow takes seconds to import, so it is only imported once the first
+# batch of reviews needs to be embedded (see import_tensorflow).
+tf = None
+hub = None
 
 # This flag disables GPU usage. Comment to use GPU with tensorflow.
 os.environ["CUDA_VISIBLE_DEVICES"] = "-1"
 
 CLUSTER_LABELS_FILE = "cluster_labels.txt"
+MODEL_URL = "https://tfhub.dev/google/universal-sentence-encoder-multilingual/3"
+MODEL_CACHE_DIR = "models"
+MIN_CLUSTERS = 5
+MAX_CLUSTERS = 10
+CLUSTERS_PATIENCE = 3
+MAX_CLUSTER_WORKERS = 4
+SILHOUETTE = "silhouette"
+CALINSKI_HARABASZ = "calinski_harabasz"
+DAVIES_BOULDIN = "davies_bouldin"
+SCORE_THRESHOLD = 2000
+EMBEDDING_STORE_DIR = "embeddings"
+EMBEDDING_STORE_ROWS = 100000
+
+
+def import_tensorflow():
+  """Imports TensorFlow and TensorFlow Hub, unless they are already imported."""
+  global tf, hub
+  if tf:
+    return
+
+  import tensorflow.compat.v2 as tf  # pylint: disable=g-import-not-at-top
+  import tensorflow_hub as hub  # pylint: disable=g-import-not-at-top
+  # Registers the ops used by the multilingual model.
+  import tensorflow_text  # pylint: disable=g-import-not-at-top,unused-import
+
+  # Reduce verbosity of tensorflow
+  tf.get_logger().setLevel("ERROR")
 
 
 class TopicClustering(object):
   """Handles the clustering of reviews into topics."""
 
-  def __init__(self):
-    # Reduce verbosity of tensorflow
-    tf.get_logger().setLevel("ERROR")
+  def __init__(
+      self,
+      model_cache_dir=None,
+      num_clusters_list=None,
+      patience=CLUSTERS_PATIENCE,
+      score_method=SILHOUETTE,
+      score_threshold=SCORE_THRESHOLD,
+      embedding_store_rows=EMBEDDING_STORE_ROWS,
+  ):
     default_folder = os.path.dirname(os.path.realpath(__file__))
     self.cluster_labels_file_location = os.path.join(
         default_folder, CLUSTER_LABELS_FILE
     )
-
-    self.model = hub.load(
-        "https://tfhub.dev/google/universal-sentence-encoder-multilingual/3"
+    self.model_cache_dir = model_cache_dir or os.path.join(
+        default_folder, MODEL_CACHE_DIR
+    )
+    self._model = None
+    self.num_clusters_list = num_clusters_list or list(
+        range(MIN_CLUSTERS, MAX_CLUSTERS + 1)
     )
+    self.patience = patience
+    self.score_method = score_method
+    self.score_threshold = score_threshold
+    self.embedding_store = None
+    if embedding_store_rows:
+      self.embedding_store = EmbeddingStore(
+          os.path.join(self.model_cache_dir, EMBEDDING_STORE_DIR),
+          MODEL_URL,
+          embedding_store_rows,
+      )
 
     self.candidate_cluster_names = []
 
@@ -55,6 +105,48 @@ class TopicClustering(object):
 
       labels_file.close()
 
+  @property
+  def model(self):
+    """The sentence encoder, loaded the first time it is used.
+
+    The model is downloaded from MODEL_URL into the model cache directory once,
+    and loaded from there afterwards.
+    """
+    if self._model is None:
+      import_tensorflow()
+      # Overrides any TFHUB_CACHE_DIR of the environment, so that the model
+      # and the embedding store share the same cache directory.
+      os.environ["TFHUB_CACHE_DIR"] = self.model_cache_dir
+      logging.info(
+          f"Loading the topic clustering model from {MODEL_URL} (cached in"
+          f" {self.model_cache_dir})..."
+      )
+      self._model = hub.load(MODEL_URL)
+
+    return self._model
+
+  def embed(self, texts):
+    """Returns the embeddings of texts, from the embedding store if possible.
+
+    The model is only loaded if some of the texts are not stored yet.
+
+    Args:
+      texts: a list, series or single-column data frame of strings.
+
+    Returns:
+      float32 numpy matrix with the embedding of each text.
+    """
+    texts = [str(text) for text in np.asarray(texts, dtype=object).ravel()]
+    if not self.embedding_store:
+      return np.asarray(self.model(texts), dtype=np.float32)
+
+    return self.embedding_store.embed(texts, self.model)
+
+  def close(self):
+    """Closes the embedding store."""
+    if self.embedding_store:
+      self.embedding_store.close()
+
   def recommend_topics(self, nouns):
     """Recommends a list of topics for a given set of nouns based on repetition.
 
@@ -88,21 +180,26 @@ class TopicClustering(object):
       Nothing.
     """
     nouns = [
-        self.extract_tokens(review["annotation"]["tokens"], "NOUN")
+        self.extract_tokens(
+            (review.get("annotation") or {}).get("tokens", []), "NOUN"
+        )
         for review in reviews
     ]
 
     if not self.candidate_cluster_names:
       self.candidate_cluster_names = self.recommend_topics(nouns)
 
-    topics = self.modelling_pipeline(pd.DataFrame(nouns), [5, 10])
+    topics = self.modelling_pipeline(
+        pd.DataFrame(nouns), self.num_clusters_list
+    )
 
     topics = topics.to_list()
     for review in reviews:
       review["topic"] = topics.pop(0)
     return
 
-  def extract_tokens(self, token_syntax, tag):
+  @staticmethod
+  def extract_tokens(token_syntax, tag):
     """Extracts specified token type for API request.
 
     Args:
@@ -123,6 +220,11 @@ class TopicClustering(object):
   def modelling_pipeline(self, reviews, num_clusters_list, max_iterations=10):
     """Runs the clustering modelling pipeline with k-means.
 
+    The candidate numbers of clusters are fitted in increasing order, a few at
+    a time, and the fit with the best score is kept (see
+    score_clusters). The sweep stops early once `patience` candidates in a
+    row have not improved on the best one.
+
     Args:
       reviews: pandas series of strings to assign to clusters
       num_clusters_list: a list of the number of clusters to attempt. The
@@ -135,26 +237,49 @@ class TopicClustering(object):
     """
     if not isinstance(num_clusters_list, list):
       raise ValueError("num_clusters_list is not a list")
-    vectors = self.model(reviews)
-
-    scores = [
-        self.generate_silhouette_score(vectors, k, max_iterations)
-        for k in num_clusters_list
-    ]
-
-    scores = dict(zip(num_clusters_list, scores))
-    best_silhouette_score = max(scores, key=scores.get)
-    logging.info(
-        f"Optimal clusters is {best_silhouette_score} with silhouette score"
-        f" {scores[best_silhouette_score]}"
-    )
-
-    cluster_indices, cluster_centers = self.generate_clusters(
-        vectors, best_silhouette_score, max_iterations
-    )
+    vectors = self.embed(reviews)
+
+    # The silhouette coefficient needs at least one review more than clusters.
+    candidates = sorted(
+        {k for k in num_clusters_list if 1 < k < len(vectors)}
+    ) or [min(min(num_clusters_list), len(vectors))]
+
+    fits = {}
+    best = None
+    since_best = 0
+    # NumPy already spreads each fit over several cores, and fitting more than
+    # patience + 1 candidates at a time would leave nothing to stop early.
+    workers = min(os.cpu_count() or 1, MAX_CLUSTER_WORKERS)
+    if self.patience:
+      workers = min(workers, self.patience + 1)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+      for start in range(0, len(candidates), workers):
+        wave = candidates[start : start + workers]
+        for k, fit in zip(
+            wave,
+            pool.map(
+                lambda k: self.fit_clusters(vectors, k, max_iterations), wave
+            ),
+        ):
+          fits[k] = fit
+          if best is None or fit[0] > fits[best][0]:
+            best = k
+            since_best = 0
+          else:
+            since_best = since_best + 1
+
+        if self.patience and since_best >= self.patience:
+          logging.info(
+              f"Stopping the search for the optimal clusters at {wave[-1]}"
+              " clusters."
+          )
+          break
+
+    score, cluster_indices, cluster_centers = fits[best]
+    logging.info(f"Optimal clusters is {best} with score {score}")
 
     index = self.return_most_similar_index(
-        cluster_centers, self.model(self.candidate_cluster_names)
+        cluster_centers, self.embed(self.candidate_cluster_names)
     )
 
     cluster_names = dict(
@@ -166,6 +291,89 @@ class TopicClustering(object):
 
     return pd.Series(cluster_indices).map(cluster_names)
 
+  def fit_clusters(self, vectors, num_clusters, max_iterations=10, seed=32):
+    """Clusters the vectors and scores the clusters.
+
+    Args:
+        vectors: matrix containing the embeddings of the reviews
+        num_clusters: the number of clusters to use
+        max_iterations: the maximum number of iterations for k-means to perform
+        seed: seed
+
+    Returns:
+        a (score, cluster indices, cluster centers) tuple
+    """
+    cluster_indices, cluster_centers = self.generate_clusters(
+        vectors, num_clusters, max_iterations=max_iterations, seed=seed
+    )
+
+    score = self.score_clusters(vectors, cluster_indices, seed)
+
+    logging.info(f"{num_clusters} clusters yields {score} score")
+    return score, cluster_indices, cluster_centers
+
+  def score_clusters(self, vectors, cluster_indices, seed=32):
+    """Scores how well the vectors are clustered, the higher the better.
+
+    Batches of up to score_threshold vectors are scored with the silhouette
+    coefficient, which takes quadratic time and memory. Larger batches are
+    scored with the silhouette coefficient of a stratified sample of
+    score_threshold vectors, or with the Calinski-Harabasz index or the
+    (negated) Davies-Bouldin index of all the vectors, which take linear time
+    and memory.
+
+    Args:
+        vectors: matrix containing the embeddings of the reviews
+        cluster_indices: the cluster index of each vector
+        seed: seed of the sample
+
+    Returns:
+        the score as a float, or -1 if there are too few clusters to score
+    """
+    from sklearn import metrics
+
+    cluster_indices = np.asarray(cluster_indices)
+    if not 1 < len(np.unique(cluster_indices)) < len(vectors):
+      return -1
+
+    if len(vectors) <= self.score_threshold or self.score_method == SILHOUETTE:
+      if len(vectors) > self.score_threshold:
+        sample = self.sample_clusters(
+            cluster_indices, self.score_threshold, seed
+        )
+        vectors = vectors[sample]
+        cluster_indices = cluster_indices[sample]
+        if not 1 < len(np.unique(cluster_indices)) < len(vectors):
+          return -1
+      return metrics.silhouette_score(vectors, cluster_indices)
+    if self.score_method == CALINSKI_HARABASZ:
+      return metrics.calinski_harabasz_score(vectors, cluster_indices)
+    return -metrics.davies_bouldin_score(vectors, cluster_indices)
+
+  def sample_clusters(self, cluster_indices, sample_size, seed=32):
+    """Samples vectors in proportion to the size of their clusters.
+
+    Args:
+        cluster_indices: numpy array with the cluster index of each vector
+        sample_size: the approximate number of vectors to sample
+        seed: seed
+
+    Returns:
+        numpy array with the positions of the sampled vectors
+    """
+    random = np.random.default_rng(seed)
+    sample = []
+    for cluster in np.unique(cluster_indices):
+      members = np.flatnonzero(cluster_indices == cluster)
+      size = round(sample_size * len(members) / len(cluster_indices))
+      sample.append(
+          random.choice(
+              members, size=min(max(size, 1), len(members)), replace=False
+          )
+      )
+
+    return np.concatenate(sample)
+
   def generate_silhouette_score(
       self, vectors, num_clusters, max_iterations=10, seed=32
   ):
@@ -178,7 +386,7 @@ class TopicClustering(object):
     been assigned to the wrong cluster, as a different cluster is more similar.
 
     Args:
-        vectors: Tensor containing the embeddings of the review
+        vectors: matrix containing the embeddings of the reviews
         num_clusters: the number of clusters to use
         max_iterations: the maximum number of iterations for k-means to perform
         seed: seed
@@ -186,62 +394,90 @@ class TopicClustering(object):
     Returns:
         silhouette score as a float
     """
-    cluster_indices, _ = self.generate_clusters(
-        vectors, num_clusters, max_iterations=max_iterations, seed=seed
-    )
-
-    score = silhouette_score(vectors.numpy(), np.array(cluster_indices))
-
-    logging.info(f"{num_clusters} clusters yields {score} silhouette score")
-    return score
+    return self.fit_clusters(vectors, num_clusters, max_iterations, seed)[0]
 
   def generate_clusters(
       self, vectors, num_clusters, max_iterations=10, seed=32
   ):
     """Generates clusters using vectors using K-means on cosine distance.
 
+    This is spherical k-means: the vectors and the cluster centers are
+    normalized, so that the cosine similarity is a dot product and every
+    iteration is a single matrix multiplication.
+
     Args:
-      vectors: Tensor containing the embeddings of the reviews
+      vectors: matrix containing the embeddings of the reviews
       num_clusters: the number of clusters to use
       max_iterations: the maximum number of iterations for k-means to perform
       seed: seed
 
     Returns:
-      df with named topics
+      the cluster index of each vector and the cluster centers
     """
-    kmeans = tf.compat.v1.estimator.experimental.KMeans(
-        num_clusters=num_clusters,
-        use_mini_batch=False,
-        seed=seed,
-        distance_metric=tf.compat.v1.estimator.experimental.KMeans.COSINE_DISTANCE,
-    )
-
-    def input_fn():
-      return tf.compat.v1.train.limit_epochs(
-          # first convert to numpy due to v1 & eager incompatability
-          tf.convert_to_tensor(vectors.numpy(), dtype=tf.float32),
-          num_epochs=1,
-      )
-
-    previous_centers = None
-    score = 0
+    vectors = self.normalize(np.asarray(vectors, dtype=np.float32))
+    random = np.random.default_rng(seed)
+    cluster_centers = self.initialize_centers(vectors, num_clusters, random)
+    cluster_indices = None
 
     for i in range(max_iterations):
-      kmeans.train(input_fn)
-      cluster_centers = kmeans.cluster_centers()
-      if previous_centers is not None:
-        previous_centers = cluster_centers
-      new_score = kmeans.score(input_fn)  # sum of squared distances
-      # break if score improves by less than (arbitrary) 10%
+      similarity = vectors @ cluster_centers.T
+      new_indices = similarity.argmax(axis=1)
       logging.debug(
-          "Iteration %d - Sum of squared distances: %.0f", i, new_score
+          "Iteration %d - Sum of cosine distances: %.0f",
+          i,
+          np.sum(1 - similarity.max(axis=1)),
       )
-      if np.divide(score, new_score) > 1.1 or score == 0:
-        score = new_score
-      else:
+      if cluster_indices is not None and np.array_equal(
+          new_indices, cluster_indices
+      ):
         break
+      cluster_indices = new_indices
+
+      sums = np.zeros_like(cluster_centers)
+      np.add.at(sums, cluster_indices, vectors)
+      # Empty clusters keep their previous center.
+      empty = ~sums.any(axis=1)
+      sums[empty] = cluster_centers[empty]
+      cluster_centers = self.normalize(sums)
+
+    return list(cluster_indices), cluster_centers
+
+  def initialize_centers(self, vectors, num_clusters, random):
+    """Picks the initial cluster centers among the vectors with k-means++.
 
-    return list(kmeans.predict_cluster_index(input_fn)), cluster_centers
+    Every center is picked with a probability proportional to the cosine
+    distance of the vector to the closest center already picked.
+
+    Args:
+      vectors: matrix containing the normalized embeddings of the reviews
+      num_clusters: the number of clusters to use
+      random: the numpy random generator to pick the centers with
+
+    Returns:
+      matrix containing the initial cluster centers
+    """
+    num_clusters = min(num_clusters, len(vectors))
+    centers = [random.integers(len(vectors))]
+    distances = np.clip(1 - vectors @ vectors[centers[0]], 0, None)
+
+    for _ in range(1, num_clusters):
+      total = distances.sum()
+      if total > 0:
+        center = random.choice(len(vectors), p=distances / total)
+      else:
+        center = random.integers(len(vectors))
+      centers.append(center)
+      distances = np.minimum(
+          distances, np.clip(1 - vectors @ vectors[center], 0, None)
+      )
+
+    return vectors[centers].copy()
+
+  @staticmethod
+  def normalize(vectors):
+    """Scales the rows of a matrix to unit length, leaving zero rows as is."""
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
 
   def return_most_similar_index(self, a, b, limit_cosine_similarity=0):
     """Returns the elements in b with the highest cosine similarity in a.
@@ -250,19 +486,17 @@ class TopicClustering(object):
     for an element to be returned (and returns -1 for these values).
 
     Args:
-      a: Tensor of vectors
-      b: Tensor of vectors
+      a: matrix of vectors
+      b: matrix of vectors
       limit_cosine_similarity: integer between 0 and 1
     """
-    similarity = tf.reduce_sum(a[:, tf.newaxis] * b, axis=-1)
-
-    similarity = tf.math.divide(
-        similarity, tf.norm(a[:, tf.newaxis], axis=-1) * tf.norm(b, axis=-1)
+    similarity = self.normalize(np.asarray(a, dtype=np.float32)) @ (
+        self.normalize(np.asarray(b, dtype=np.float32)).T
     )
 
-    indices = tf.math.argmax(similarity, axis=1).numpy()
+    indices = similarity.argmax(axis=1)
     if limit_cosine_similarity > 0:
-      max_cosine_similarity = tf.math.reduce_max(similarity, axis=1).numpy()
+      max_cosine_similarity = similarity.max(axis=1)
       indices[max_cosine_similarity < limit_cosine_similarity] = -1
 
     return indices